@@ -6,6 +6,199 @@ This is free and unencumbered software released into the public domain.
 
 Implementation of Bellman-Ford Algorithm for Lab 3.
 """
+from array import array
+from collections import deque
+from collections.abc import Mapping
+
+
+class EdgeStore(object):
+    """
+    Compact edge storage for BellmanFord. Vertices are interned to small
+    integer ids the first time they are seen, and each edge occupies one
+    slot of the parallel src/dst/weight/timestamp arrays. The slots index
+    maps a source id to {destination id: slot}, so upserting, finding and
+    deleting an edge are all O(1). Deleting moves the last edge into the
+    freed slot, which keeps the arrays dense.
+
+    >>> store = EdgeStore()
+    >>> a, b, c = store.intern('a'), store.intern('b'), store.intern('c')
+    >>> store.upsert(a, b, 1.5), store.upsert(b, c, 2.0), store.upsert(a, b, 0.5)
+    (0, 1, 0)
+    >>> store.delete(a, b)
+    >>> list(store.src), list(store.dst), list(store.weight)
+    ([1], [2], [2.0])
+    """
+    __slots__ = ('ids', 'names', 'src', 'dst', 'weight', 'timestamp', 'slots')
+
+    def __init__(self):
+        self.ids = {}  # vertex -> id
+        self.names = []  # id -> vertex
+        self.src = array('l')
+        self.dst = array('l')
+        self.weight = array('d')
+        self.timestamp = array('q')
+        self.slots = {}  # src id -> {dst id: slot}, only for vertices with out-edges
+
+    def __len__(self):
+        return len(self.weight)
+
+    def intern(self, vertex):
+        """
+        Get the id for vertex, assigning the next one if it is new.
+
+        :param vertex: any hashable vertex name
+        :return: small integer id
+        """
+        i = self.ids.get(vertex)
+        if i is None:
+            i = self.ids[vertex] = len(self.names)
+            self.names.append(vertex)
+        return i
+
+    def slot(self, from_vertex, to_vertex):
+        """
+        Find the slot holding an edge.
+
+        :param from_vertex: start of edge
+        :param to_vertex: end of edge
+        :return: slot index, or None if there is no such edge
+        """
+        u, v = self.ids.get(from_vertex), self.ids.get(to_vertex)
+        if u is None or v is None or u not in self.slots:
+            return None
+        return self.slots[u].get(v)
+
+    def upsert(self, u, v, weight, timestamp=0):
+        """
+        Add the edge u -> v or overwrite its weight and timestamp.
+
+        :param u: id of start of edge
+        :param v: id of end of edge
+        :param weight: weight of edge
+        :param timestamp: integer timestamp kept alongside the edge
+        :return: slot of the edge
+        """
+        out = self.slots.get(u)
+        if out is None:
+            out = self.slots[u] = {}
+        slot = out.get(v)
+        if slot is None:
+            slot = out[v] = len(self.weight)
+            self.src.append(u)
+            self.dst.append(v)
+            self.weight.append(weight)
+            self.timestamp.append(timestamp)
+        else:
+            self.weight[slot] = weight
+            self.timestamp[slot] = timestamp
+        return slot
+
+    def delete(self, u, v):
+        """
+        Remove the edge u -> v, raising KeyError if there isn't one.
+
+        :param u: id of start of edge
+        :param v: id of end of edge
+        """
+        out = self.slots[u]
+        slot = out.pop(v)
+        if not out:
+            del self.slots[u]
+        last = len(self.weight) - 1
+        if slot != last:
+            moved_u, moved_v = self.src[last], self.dst[last]
+            self.src[slot], self.dst[slot] = moved_u, moved_v
+            self.weight[slot] = self.weight[last]
+            self.timestamp[slot] = self.timestamp[last]
+            self.slots[moved_u][moved_v] = slot
+        for column in (self.src, self.dst, self.weight, self.timestamp):
+            column.pop()
+
+
+class EdgesView(Mapping):
+    """
+    Read-only {from_vertex: {to_vertex: weight}} view of an EdgeStore.
+    """
+    __slots__ = ('store',)
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, from_vertex):
+        u = self.store.ids.get(from_vertex)
+        if u is None or u not in self.store.slots:
+            raise KeyError(from_vertex)
+        return AdjacencyView(self.store, u)
+
+    def __iter__(self):
+        names = self.store.names
+        return (names[u] for u in self.store.slots)
+
+    def __len__(self):
+        return len(self.store.slots)
+
+    def __repr__(self):
+        return repr({u: dict(self[u]) for u in self})
+
+
+class AdjacencyView(Mapping):
+    """
+    Read-only {to_vertex: weight} view of the out-edges of one vertex.
+    """
+    __slots__ = ('store', 'u')
+
+    def __init__(self, store, u):
+        self.store = store
+        self.u = u
+
+    def __getitem__(self, to_vertex):
+        try:
+            return self.store.weight[self.store.slots[self.u][self.store.ids[to_vertex]]]
+        except KeyError:
+            raise KeyError(to_vertex)
+
+    def __iter__(self):
+        names = self.store.names
+        return (names[v] for v in self.store.slots.get(self.u, ()))
+
+    def __len__(self):
+        return len(self.store.slots.get(self.u, ()))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class VertexMap(Mapping):
+    """
+    Read-only {vertex: value} view of a list indexed by vertex id, as
+    returned for shortest-path distances and predecessors. If the values
+    are vertex ids themselves (predecessors), they are shown as vertices,
+    with a negative id shown as None.
+    """
+    __slots__ = ('store', 'values', 'of_vertices')
+
+    def __init__(self, store, values, of_vertices=False):
+        self.store = store
+        self.values = values
+        self.of_vertices = of_vertices
+
+    def __getitem__(self, vertex):
+        i = self.store.ids[vertex]
+        if i >= len(self.values):
+            raise KeyError(vertex)
+        value = self.values[i]
+        if self.of_vertices:
+            return self.store.names[value] if value >= 0 else None
+        return value
+
+    def __iter__(self):
+        return iter(self.store.names[:len(self.values)])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return repr(dict(self))
 
 
 class BellmanFord(object):
@@ -13,17 +206,41 @@ class BellmanFord(object):
     Graph suitable for Bellman-Ford Algorithm. Edges are added with the
     add_edge method. Shortest paths (and cycles)
     can then be determined with the shortest_paths method.
+
+    The graph itself lives in an EdgeStore, self.store; the vertices and
+    edges attributes are read-only views of it.
+
+    With work_list=True, shortest_paths uses a queue of vertices whose
+    distance just improved (SPFA) instead of full passes over every edge,
+    which is close to linear in the number of edges on graphs that settle
+    quickly. Both modes give the same distances.
+
+    >>> g = BellmanFord({'a': {'b': 1, 'c':5}, 'b': {'c': 2}, 'c': {'d': -3}}, work_list=True)
+    >>> dist, prev, neg_edge = g.shortest_paths('a')
+    >>> [(v, dist[v]) for v in sorted(dist)]
+    [('a', 0), ('b', 1.0), ('c', 3.0), ('d', 0.0)]
+    >>> g.add_edge('d', 'b', -1)
+    >>> g.shortest_paths('a')[2]
+    ('d', 'b')
+    >>> g.edges['d']
+    {'b': -1.0}
     """
 
-    def __init__(self, initial_edges=None):
-        self.vertices = set()
-        self.edges = {}
+    def __init__(self, initial_edges=None, work_list=False):
+        self.store = EdgeStore()
+        self.edges = EdgesView(self.store)
+        self.work_list = work_list
         if initial_edges is not None:
             for u in initial_edges:
                 for v in initial_edges[u]:
                     self.add_edge(u, v, initial_edges[u][v])
 
-    def add_edge(self, from_vertex, to_vertex, weight):
+    @property
+    def vertices(self):
+        """Set-like view of every vertex ever added to this graph."""
+        return self.store.ids.keys()
+
+    def add_edge(self, from_vertex, to_vertex, weight, timestamp=0):
         """
         Add an edge (and possibly the from and to vertices) to this graph.
         If the edge already exists, the weight is changed to the given one.
@@ -31,22 +248,64 @@ class BellmanFord(object):
         :param from_vertex: start of edge
         :param to_vertex: end of edge
         :param weight: weight of edge
+        :param timestamp: integer timestamp to keep with the edge
         """
         if from_vertex == to_vertex:
             raise ValueError(
                 '{} -> {}: {}'.format(from_vertex, to_vertex, weight))
-        self.vertices.add(from_vertex)
-        self.vertices.add(to_vertex)
-        if from_vertex not in self.edges:
-            self.edges[from_vertex] = {}
-        self.edges[from_vertex][to_vertex] = weight
+        store = self.store
+        store.upsert(store.intern(from_vertex), store.intern(to_vertex), weight, timestamp)
 
     def remove_edge(self, from_vertex, to_vertex):
         try:
-            del self.edges[from_vertex][to_vertex]
+            self.store.delete(self.store.ids[from_vertex], self.store.ids[to_vertex])
         except KeyError:
             raise KeyError('remove_edge({}, {})'.format(from_vertex, to_vertex))
 
+    def snapshot(self):
+        """
+        Compact, picklable copy of the graph for shipping to another process:
+        the vertex names by id plus the raw bytes of the src, dst and weight
+        arrays. Timestamps are left out.
+
+        :return: (names, src bytes, dst bytes, weight bytes)
+        """
+        store = self.store
+        return list(store.names), store.src.tobytes(), store.dst.tobytes(), store.weight.tobytes()
+
+    @classmethod
+    def from_snapshot(cls, snapshot, work_list=False, indexed=True):
+        """
+        Rebuild a graph from the result of snapshot(). Vertex ids are the
+        same as in the original graph.
+
+        >>> g = BellmanFord({'a': {'b': 1}, 'b': {'c': 2}})
+        >>> BellmanFord.from_snapshot(g.snapshot()).edges
+        {'a': {'b': 1.0}, 'b': {'c': 2.0}}
+
+        :param snapshot: (names, src bytes, dst bytes, weight bytes)
+        :param work_list: as for the constructor
+        :param indexed: build the index from each edge to its slot, a Python
+                        loop over every edge that costs far more than copying
+                        the arrays; without it the graph is only good for
+                        full-pass searches (work_list False), not for
+                        changing edges or looking them up
+        :return: new graph
+        """
+        names, src, dst, weight = snapshot
+        g = cls(work_list=work_list)
+        store = g.store
+        store.names = list(names)
+        store.ids = {name: i for i, name in enumerate(names)}
+        store.src.frombytes(src)
+        store.dst.frombytes(dst)
+        store.weight.frombytes(weight)
+        store.timestamp.extend(bytes(len(store.weight)))
+        if indexed:
+            for slot, (u, v) in enumerate(zip(store.src, store.dst)):
+                store.slots.setdefault(u, {})[v] = slot
+        return g
+
     def shortest_paths(self, start_vertex, tolerance=0):
         """
         Find the shortest paths (sum of edge weights) from start_vertex to
@@ -62,7 +321,7 @@ class BellmanFord(object):
         >>> g = BellmanFord({'a': {'b': 1, 'c':5}, 'b': {'c': 2, 'a': 10}, 'c': {'a': 14, 'd': -3}, 'e': {'a': 100}})
         >>> dist, prev, neg_edge = g.shortest_paths('a')
         >>> [(v, dist[v]) for v in sorted(dist)]  # shortest distance from 'a' to each other vertex
-        [('a', 0), ('b', 1), ('c', 3), ('d', 0), ('e', inf)]
+        [('a', 0), ('b', 1.0), ('c', 3.0), ('d', 0.0), ('e', inf)]
         >>> [(v, prev[v]) for v in sorted(prev)]  # last edge in shortest paths
         [('a', None), ('b', 'a'), ('c', 'b'), ('d', 'c'), ('e', None)]
         >>> neg_edge is None
@@ -76,37 +335,330 @@ class BellmanFord(object):
         :param tolerance: only if a path is more than tolerance better will
                           it be relaxed
         :return: (distance, predecessor, negative_cycle)
-            distance:       dictionary keyed by vertex of shortest distance
+            distance:       mapping keyed by vertex of shortest distance
                             from start_vertex to that vertex
-            predecessor:    dictionary keyed by vertex of previous vertex in
+            predecessor:    mapping keyed by vertex of previous vertex in
                             shortest path from start_vertex
             negative_cycle: None if no negative cycle, otherwise an edge,
                             (u,v), in one such cycle
         """
+        start = self.store.ids.get(start_vertex)
+        if start is None:  # no edges at all from or to start_vertex
+            distance = dict.fromkeys(self.vertices, float('inf'))
+            distance[start_vertex] = 0
+            return distance, dict.fromkeys(distance), None
+        return self._as_mappings(*self._shortest_paths(start, tolerance))
+
+    def _shortest_paths(self, start, tolerance):
+        """
+        Shortest paths by vertex id.
+
+        :param start: id of start_vertex
+        :param tolerance: as for shortest_paths
+        :return: (distance, predecessor, negative_cycle) where distance and
+                 predecessor are lists indexed by vertex id (no predecessor
+                 is -1) and negative_cycle is None or a (u, v) pair of ids
+        """
         # initialize
-        distance, predecessor = {}, {}
-        for v in self.vertices:
-            distance[v] = float('inf')
-            predecessor[v] = None
-        distance[start_vertex] = 0
+        n = len(self.store.names)
+        distance = [float('inf')] * n
+        predecessor = [-1] * n
+        distance[start] = 0
+
+        if self.work_list:
+            negative_cycle = self._relax_from([start], distance, predecessor, start, tolerance)
+            return distance, predecessor, negative_cycle
 
         # repeated relaxation
-        for i in range(len(self.vertices)):
-            for u in self.edges:
-                for v in self.edges[u]:
-                    w = self.edges[u][v]
-                    if distance[v] - (distance[u] + w) > tolerance:
-                        if v == start_vertex:
-                            return distance, predecessor, (u, v)
-                        distance[v] = distance[u] + w
-                        predecessor[v] = u
+        edges = self.store.src, self.store.dst, self.store.weight
+        for i in range(n):
+            relaxed = False
+            for u, v, w in zip(*edges):
+                if distance[v] - (distance[u] + w) > tolerance:
+                    if v == start:
+                        return distance, predecessor, (u, v)
+                    distance[v] = distance[u] + w
+                    predecessor[v] = u
+                    relaxed = True
+            if not relaxed:  # converged, so there can't be a negative cycle
+                return distance, predecessor, None
 
         # check for negative cycles
-        negative_cycle = None
-        for u in self.edges:
-            for v in self.edges[u]:
-                w = self.edges[u][v]
-                if distance[v] - (distance[u] + w) > tolerance:
-                    return distance, predecessor, (u, v)
+        for u, v, w in zip(*edges):
+            if distance[v] - (distance[u] + w) > tolerance:
+                return distance, predecessor, (u, v)
 
         return distance, predecessor, None
+
+    def _as_mappings(self, distance, predecessor, negative_cycle):
+        """
+        Wrap the results of _shortest_paths in vertex-keyed mappings.
+        """
+        if negative_cycle is not None:
+            names = self.store.names
+            negative_cycle = (names[negative_cycle[0]], names[negative_cycle[1]])
+        return (VertexMap(self.store, distance),
+                VertexMap(self.store, predecessor, of_vertices=True),
+                negative_cycle)
+
+    def negative_cycles(self, tolerance=0, k=None):
+        """
+        Find distinct negative cycles anywhere in the graph, most negative
+        first.
+
+        Relaxation starts from a virtual source with a zero-weight edge to
+        every vertex, so cycles are found whether or not they are reachable
+        from any particular vertex. It works from a queue of vertices whose
+        distance went down, as with work_list. Whenever a relaxation makes a
+        vertex its own ancestor in the predecessor graph, which is the only
+        way a cycle can appear there, that cycle is collected if its weight
+        is below -tolerance.
+
+        Relaxation tends to settle on a few cycles and hide the rest, so the
+        edges of each cycle are taken out of the sweep as soon as it is
+        found, and relaxation goes on from the distances so far, only
+        revisiting the vertices it still improves, until no negative cycle
+        is left. Listing every negative cycle can take exponential time, so
+        this doesn't: a cycle that shares an edge with one already found may
+        be missed. But every negative cycle in the graph shares at least one
+        edge with a cycle returned (or with a cycle whose weight is within
+        tolerance of zero, which isn't returned), so in particular no cycle
+        disjoint from all the others is missed.
+
+        >>> g = BellmanFord({'a': {'b': 1}, 'b': {'a': -2}, 'c': {'d': -1}, 'd': {'c': 0.5}, 'e': {'a': 3}})
+        >>> g.negative_cycles()
+        [(-1.0, ['a', 'b', 'a']), (-0.5, ['d', 'c', 'd'])]
+        >>> g.negative_cycles(k=1)
+        [(-1.0, ['a', 'b', 'a'])]
+
+        :param tolerance: as for shortest_paths
+        :param k: maximum number of cycles to return (default is all found)
+        :return: list of (weight, cycle) pairs sorted by weight, where cycle
+                 is a list of vertices that starts and ends on the same one
+        """
+        store = self.store
+        n = len(store.names)
+        weight = store.weight
+        slots = {u: dict(out) for u, out in store.slots.items()}  # the edges still in the sweep
+        distance = [0] * n
+        predecessor = [-1] * n
+        found = {}  # frozenset of a cycle's edges -> (weight, cycle)
+        queue = deque(u for u in range(n) if u in slots)
+        queued = [u in slots for u in range(n)]
+        while queue:
+            u = queue.popleft()
+            queued[u] = False
+            out = slots.get(u)
+            if not out:
+                continue
+            closed = False
+            from_u = distance[u]
+            for v, slot in out.items():
+                to_v = from_u + weight[slot]
+                if distance[v] - to_v > tolerance:
+                    distance[v] = to_v
+                    predecessor[v] = u
+                    if not queued[v]:
+                        queue.append(v)
+                        queued[v] = True
+                    if not closed:  # walk up from u to see if v is above it
+                        ancestor, steps = u, 0
+                        while ancestor >= 0 and ancestor != v and steps < n:
+                            ancestor, steps = predecessor[ancestor], steps + 1
+                        closed = ancestor == v
+            if not closed:
+                continue
+            # however many edges out of u closed a cycle, the last one leaves u on the only one
+            cycle = [u]
+            ancestor = predecessor[u]
+            while ancestor != u:
+                cycle.append(ancestor)
+                ancestor = predecessor[ancestor]
+            cycle.append(u)
+            cycle.reverse()
+            key = frozenset(zip(cycle, cycle[1:]))
+            cycle_weight = sum(weight[store.slots[a][b]] for a, b in key)
+            if cycle_weight < -tolerance:
+                found[key] = (cycle_weight, cycle)
+            # a cycle within rounding of zero can keep relaxing too, so it comes out either way
+            for a, b in key:
+                del slots[a][b]
+                predecessor[b] = -1
+        ranked = sorted(found.values(), key=lambda found_cycle: found_cycle[0])
+        if k is not None:
+            ranked = ranked[:k]
+        return [(weight, [store.names[v] for v in cycle]) for weight, cycle in ranked]
+
+    def _relax_from(self, sources, distance, predecessor, start, tolerance):
+        """
+        Relax outward from the given vertices until nothing improves, only
+        revisiting vertices whose distance went down. Vertices are queued in
+        FIFO order, so without a negative cycle none can be queued again
+        more than |V| - 1 times.
+
+        :param sources: ids of vertices whose outgoing edges need relaxing
+        :param distance: distances by vertex id to update in place
+        :param predecessor: predecessor ids by vertex id to update in place
+        :param start: id of start_vertex
+        :param tolerance: as for shortest_paths
+        :return: None, or a (u, v) pair of ids of an edge in a negative cycle
+        """
+        slots, weight = self.store.slots, self.store.weight
+        queue = deque(sources)
+        queued = set(sources)
+        requeued = {}
+        limit = len(self.store.names)
+        while queue:
+            u = queue.popleft()
+            queued.discard(u)
+            if u not in slots:
+                continue
+            for v, slot in slots[u].items():
+                w = weight[slot]
+                if distance[v] - (distance[u] + w) > tolerance:
+                    if v == start:
+                        return u, v
+                    distance[v] = distance[u] + w
+                    predecessor[v] = u
+                    if v not in queued:
+                        requeued[v] = requeued.get(v, 0) + 1
+                        if requeued[v] >= limit:
+                            return u, v
+                        queue.append(v)
+                        queued.add(v)
+        return None
+
+
+class SearchState(object):
+    """
+    What IncrementalBellmanFord remembers about the last search from one
+    start vertex.
+    """
+    __slots__ = ('distance', 'predecessor', 'tolerance', 'lowered', 'full_pass_needed')
+
+    def __init__(self, distance, predecessor, tolerance):
+        self.distance, self.predecessor = distance, predecessor  # by vertex id
+        self.tolerance = tolerance
+        self.lowered = set()  # ids of start vertices of edges that were added or got cheaper since
+        self.full_pass_needed = False
+
+
+class IncrementalBellmanFord(BellmanFord):
+    """
+    BellmanFord graph that remembers the distances and predecessors from the
+    last shortest_paths call from each start vertex and updates them as
+    edges change, instead of starting over from scratch every time. Searching
+    from several start vertices in turn (e.g. one per origin currency) keeps
+    every one of them incremental.
+
+    Lowering (or adding) an edge only needs relaxation outward from that
+    edge's start vertex. Raising or removing an edge can lengthen shortest
+    paths, so that forces a full pass, but only if the edge is actually in
+    the current shortest-path tree; otherwise no path used it.
+
+    On a live quote feed that rarely pays off: every requote raises one
+    direction of its cross, which is usually a tree edge, and arbitrage
+    (or a cycle within rounding of zero) forces a full pass too, so with
+    the bookkeeping on top this is slower than BellmanFord there. Lab3
+    uses BellmanFord by default for that reason.
+
+    >>> g = IncrementalBellmanFord({'a': {'b': 1, 'c': 5}, 'b': {'c': 2}, 'c': {'d': -3}})
+    >>> dist, prev, neg_edge = g.shortest_paths('a')
+    >>> [(v, dist[v]) for v in sorted(dist)]
+    [('a', 0), ('b', 1.0), ('c', 3.0), ('d', 0.0)]
+    >>> g.shortest_paths('b')[0]['d']
+    -1.0
+    >>> g.add_edge('a', 'd', -1)  # only relaxes from 'a', in both searches
+    >>> dist, prev, neg_edge = g.shortest_paths('a')
+    >>> dist['d'], prev['d']
+    (-1.0, 'a')
+    >>> g.searches[g.store.ids['b']].lowered == {g.store.ids['a']}
+    True
+    >>> g.add_edge('d', 'a', 0)
+    >>> g.shortest_paths('a')[2]
+    ('d', 'a')
+    """
+
+    def __init__(self, initial_edges=None, work_list=False):
+        self.searches = {}  # start vertex id -> SearchState
+        super().__init__(initial_edges, work_list)
+
+    def add_edge(self, from_vertex, to_vertex, weight, timestamp=0):
+        store = self.store
+        slot = store.slot(from_vertex, to_vertex)
+        previous = None if slot is None else store.weight[slot]
+        super().add_edge(from_vertex, to_vertex, weight, timestamp)
+        u, v = store.ids[from_vertex], store.ids[to_vertex]
+        for search in self.searches.values():
+            added = len(store.names) - len(search.distance)
+            if added:
+                search.distance.extend([float('inf')] * added)
+                search.predecessor.extend([-1] * added)
+            if previous is None or weight < previous:
+                search.lowered.add(u)
+            elif weight > previous and search.predecessor[v] == u:
+                search.full_pass_needed = True
+
+    def remove_edge(self, from_vertex, to_vertex):
+        super().remove_edge(from_vertex, to_vertex)
+        u, v = self.store.ids[from_vertex], self.store.ids[to_vertex]
+        for search in self.searches.values():
+            if search.predecessor[v] == u:
+                search.full_pass_needed = True
+
+    def shortest_paths(self, start_vertex, tolerance=0):
+        """
+        Same contract as BellmanFord.shortest_paths. The returned distance
+        and predecessor mappings are views of this object's state, so they
+        may change with later calls.
+
+        :param start_vertex: start of all paths
+        :param tolerance: only if a path is more than tolerance better will
+                          it be relaxed
+        :return: (distance, predecessor, negative_cycle)
+        """
+        start = self.store.ids.get(start_vertex)
+        if start is None:
+            return super().shortest_paths(start_vertex, tolerance)
+        search = self.searches.get(start)
+        if search is None or search.full_pass_needed or tolerance != search.tolerance:
+            distance, predecessor, negative_cycle = self._shortest_paths(start, tolerance)
+            search = self.searches[start] = SearchState(distance, predecessor, tolerance)
+        else:
+            negative_cycle = self._relax_from(search.lowered, search.distance, search.predecessor,
+                                              start, tolerance)
+            search.lowered = set()
+        # a negative cycle leaves the distances meaningless, so start over next time
+        search.full_pass_needed = negative_cycle is not None
+        return self._as_mappings(search.distance, search.predecessor, negative_cycle)
+
+
+def shortest_paths_from_snapshot(snapshot, start_vertices, tolerance=0):
+    """
+    Run shortest_paths from each of several start vertices on a graph
+    snapshot. Meant to be run in a worker process, so the results are kept
+    compact: predecessors come back as a list indexed by vertex id (-1 for
+    none), using the same ids as the graph the snapshot was taken from.
+    The snapshot's arrays are searched with full passes as they are, since
+    indexing them for a work-list search would cost more than the searches.
+
+    >>> g = BellmanFord({'a': {'b': 1}, 'b': {'a': -2}})
+    >>> shortest_paths_from_snapshot(g.snapshot(), ['a', 'b', 'z'])
+    [('a', [-1, 0], ('b', 'a')), ('b', [1, -1], ('a', 'b'))]
+
+    :param snapshot: result of BellmanFord.snapshot()
+    :param start_vertices: vertices to search from; any not in the graph
+                           are skipped
+    :param tolerance: as for shortest_paths
+    :return: list of (start_vertex, predecessor, negative_cycle) tuples
+    """
+    g = BellmanFord.from_snapshot(snapshot, indexed=False)
+    results = []
+    for start_vertex in start_vertices:
+        start = g.store.ids.get(start_vertex)
+        if start is not None:
+            distance, predecessor, negative_cycle = g._shortest_paths(start, tolerance)
+            if negative_cycle is not None:
+                negative_cycle = tuple(g.store.names[v] for v in negative_cycle)
+            results.append((start_vertex, predecessor, negative_cycle))
+    return results
@@ -0,0 +1,176 @@
+"""
+Benchmark for the Lab 3 arbitrage pipeline.
+
+Generates synthetic Forex Provider datagrams and feeds them straight into
+Lab3's processing path, with no sockets involved, timing each stage:
+unmarshal -> staleness -> graph update -> detection -> report.
+
+run python3 bench_lab3.py --currencies 100 --datagrams 2000 --engine bellman_ford --engine incremental
+"""
+import argparse
+import contextlib
+import itertools
+import math
+import os
+import random
+import statistics
+import string
+import time
+
+import fxp_bytes
+import fxp_bytes_subscriber as fxp_bytes_s
+from bellman_ford import BellmanFord, IncrementalBellmanFord
+from lab3 import Lab3
+
+STAGES = ('unmarshal', 'staleness', 'update', 'detection', 'report')
+
+
+def numpy_engine():
+    from bellman_ford_numpy import NumpyBellmanFord  # needs NumPy, so only imported if asked for
+    return NumpyBellmanFord()
+
+
+ENGINES = {
+    'bellman_ford': BellmanFord,
+    'work_list': lambda: BellmanFord(work_list=True),
+    'incremental': IncrementalBellmanFord,
+    'numpy': numpy_engine,
+}
+
+
+class SyntheticFeed(object):
+    """
+    Random-walk market over a configurable number of currencies that produces
+    datagrams in the fxp_bytes wire format, as a publisher sending at a fixed
+    rate would.
+    """
+
+    def __init__(self, currencies=20, rate=1000.0, quotes_per_message=10,
+                 out_of_order=0.10, arbitrage=0.05, seed=None):
+        """
+        Args:
+            currencies (int): Number of currencies, including USD.
+            rate (float): Datagrams per second; sets the spacing of quote times.
+            quotes_per_message (int): Quotes in each datagram.
+            out_of_order (float): Fraction of datagrams sent with old timestamps.
+            arbitrage (float): Fraction of datagrams with a 3-way arbitrage injected.
+            seed (int): Random seed, for repeatable feeds.
+        """
+        self.random = random.Random(seed)
+        codes = (''.join(letters) for letters in itertools.product(string.ascii_uppercase, repeat=3))
+        self.currencies = ['USD'] + list(itertools.islice((c for c in codes if c != 'USD'), currencies - 1))
+        self.reference = {ccy: math.exp(self.random.gauss(0, 2)) for ccy in self.currencies}  # units per USD
+        self.reference['USD'] = 1.0
+        self.interval = round(fxp_bytes.MICROS_PER_SECOND / rate)
+        self.quotes_per_message = min(quotes_per_message, fxp_bytes.MAX_QUOTES_PER_MESSAGE)
+        self.out_of_order = out_of_order
+        self.arbitrage = arbitrage
+        self.clock = fxp_bytes.now_micros()
+
+    def quote(self, base, quote_ccy, skew=1.0):
+        return (fxp_bytes.market_id((base, quote_ccy)),
+                self.reference[quote_ccy] / self.reference[base] * skew)
+
+    def datagrams(self, count):
+        """
+        Generate datagrams.
+
+        Args:
+            count (int): Number of datagrams.
+
+        Yields:
+            tuple: (datagram bytes, epoch microseconds it would have been received)
+        """
+        for _ in range(count):
+            self.clock += self.interval
+            quotes = []
+            for _ in range(self.quotes_per_message):
+                base, quote_ccy = self.random.sample(self.currencies, 2)
+                self.reference[quote_ccy] *= self.random.gauss(1.0, 0.0001)
+                quotes.append(self.quote(base, quote_ccy))
+
+            if self.random.random() < self.arbitrage:
+                a, b, c = self.random.sample(self.currencies, 3)
+                quotes[-3:] = [self.quote(a, b), self.quote(b, c), self.quote(c, a, 1.01)]
+
+            timestamp = self.clock
+            if self.random.random() < self.out_of_order:
+                timestamp -= round(self.random.gauss(10, 3) * fxp_bytes.MICROS_PER_SECOND)
+            quotes = [fxp_bytes.Quote(market, price, timestamp) for market, price in quotes]
+
+            yield fxp_bytes.marshal_message(quotes), self.clock + 200
+
+
+def run(lab, datagrams):
+    """
+    Push datagrams through the Lab3 pipeline one stage at a time.
+
+    Args:
+        lab (Lab3): Subscriber to feed.
+        datagrams (list): (datagram bytes, receive time) pairs.
+
+    Returns:
+        dict: Seconds spent in each stage for each datagram, keyed by stage name.
+    """
+    timings = {stage: [] for stage in STAGES}
+    with open(os.devnull, 'w') as devnull:
+        for byte_msg, received_at in datagrams:
+            t0 = time.perf_counter()
+            quotes = fxp_bytes_s.unmarshal_quotes(byte_msg)
+            t1 = time.perf_counter()
+            lab.remove_stale_edges(received_at)
+            t2 = time.perf_counter()
+            lab.apply_quotes(quotes, received_at)
+            t3 = time.perf_counter()
+            cycles = lab.find_arbitrage()
+            t4 = time.perf_counter()
+            with contextlib.redirect_stdout(devnull):
+                for steps in cycles:
+                    lab.print_arbitrage(steps)
+            t5 = time.perf_counter()
+            for stage, started, finished in zip(STAGES, (t0, t1, t2, t3, t4), (t1, t2, t3, t4, t5)):
+                timings[stage].append(finished - started)
+    return timings
+
+
+def report(engine, timings):
+    """
+    Print p50/p99 latency and the sustainable message rate for each stage.
+    """
+    print(f"\n{engine}")
+    print(f"{'stage':<10} {'p50 us':>10} {'p99 us':>10} {'max msg/s':>12}")
+    totals = [sum(per_stage) for per_stage in zip(*timings.values())]
+    for stage, samples in list(timings.items()) + [('total', totals)]:
+        cuts = statistics.quantiles(samples, n=100)
+        mean = statistics.fmean(samples)
+        rate = 1 / mean if mean > 0 else float('inf')
+        print(f"{stage:<10} {cuts[49] * 1e6:>10.1f} {cuts[98] * 1e6:>10.1f} {rate:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--currencies', type=int, default=20)
+    parser.add_argument('--datagrams', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=1000.0, help='datagrams per second of feed time')
+    parser.add_argument('--quotes', type=int, default=10, help='quotes per datagram')
+    parser.add_argument('--out-of-order', type=float, default=0.10)
+    parser.add_argument('--arbitrage', type=float, default=0.05)
+    parser.add_argument('--top-k', type=int, default=None, help='use Lab3 top-k cycle enumeration')
+    parser.add_argument('--cycle-cache', type=int, default=None, help='use Lab3 cycle cache with this max age')
+    parser.add_argument('--seed', type=int, default=5520)
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES),
+                        help='engine to benchmark; repeat to compare (default bellman_ford)')
+    args = parser.parse_args()
+
+    feed = SyntheticFeed(args.currencies, args.rate, args.quotes, args.out_of_order, args.arbitrage, args.seed)
+    datagrams = list(feed.datagrams(args.datagrams))
+    print(f"{args.datagrams} datagrams, {args.currencies} currencies, {args.quotes} quotes each")
+
+    for engine in args.engine or ['bellman_ford']:
+        lab = Lab3(None, None, bellman_ford=ENGINES[engine](), top_k=args.top_k, verbose=False,
+                   cycle_cache=args.cycle_cache)
+        report(engine, run(lab, datagrams))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,18 +4,84 @@ Forex Provider
 
 This module implements a staging version the Forex Provider price feed on localhost.
 """
+import argparse
+import asyncio
+import functools
+import heapq
+import inspect
+import math
+import multiprocessing
+import pickle
 import socket
 import selectors
-from datetime import datetime, timedelta
 import time
 import random
+import zlib
 import fxp_bytes
+from fxp_fanout import FanOut
+from fxp_metrics import MetricsReporter, ProviderMetrics
 
 
 REQUEST_ADDRESS = ('localhost', 50403)
-REQUEST_SIZE = 12
+REQUEST_SIZE = 2048  # address, version, a market filter of up to 255 markets, then a max rate
 REVERSE_QUOTED = {'GBP', 'EUR', 'AUD'}
 SUBSCRIPTION_TIME = 19  # 10 * 60  # seconds
+IDLE_WAIT = 100.0  # a publish() asking for a wait this long has nothing to publish until someone subscribes
+REFRESH_MICROS = 500_000  # with changed_only, resend an unchanged price this often so it doesn't go stale
+
+
+class Conflator(object):
+    """
+    Holds back updates for subscribers that asked for at most max_rate
+    messages a second, keeping only the latest price for each market until
+    the next send is due.
+
+    >>> gbp, eur = fxp_bytes.market_id('GBP/USD'), fxp_bytes.market_id('EUR/USD')
+    >>> conflator = Conflator(2)  # a send every 500,000 micros at most
+    >>> quotes, conflated = conflator.offer([fxp_bytes.Quote(gbp, 1.25, 1000)], 1000)
+    >>> [quote.price for quote in quotes], conflated
+    ([1.25], 0)
+    >>> conflator.offer([fxp_bytes.Quote(gbp, 1.26, 2000), fxp_bytes.Quote(eur, 1.1, 2000)], 2000)
+    (None, 0)
+    >>> conflator.offer([fxp_bytes.Quote(gbp, 1.27, 3000), fxp_bytes.Quote(eur, 1.0, 1500)], 3000)  # EUR/USD late
+    (None, 2)
+    >>> quotes, conflated = conflator.offer([], 501000)
+    >>> sorted((fxp_bytes.MARKETS[quote.market], quote.price) for quote in quotes)
+    [(b'EURUSD', 1.1), (b'GBPUSD', 1.27)]
+    >>> conflator.offer([], 600000)  # nothing pending
+    (None, 0)
+    """
+
+    def __init__(self, max_rate):
+        """
+        :param max_rate: most messages a second to send
+        """
+        self.interval = round(fxp_bytes.MICROS_PER_SECOND / max_rate)
+        self.next_send = 0
+        self.pending = {}  # market id -> latest fxp_bytes.Quote not yet sent
+
+    def offer(self, quotes, now):
+        """
+        Take this tick's quotes and say what to send now, if anything.
+
+        :param quotes: list of fxp_bytes.Quote
+        :param now: current time in epoch micros
+        :return: (quotes to send now or None, number of pending updates replaced)
+        """
+        pending = self.pending
+        conflated = 0
+        for quote in quotes:
+            held = pending.get(quote.market)
+            if held is not None:
+                conflated += 1
+                if held.micros > quote.micros:  # an out-of-order quote doesn't replace a newer one
+                    continue
+            pending[quote.market] = quote
+        if now < self.next_send or not pending:
+            return None, conflated
+        self.next_send = now + self.interval
+        self.pending = {}
+        return list(pending.values()), conflated
 
 
 class TestPublisher(object):
@@ -24,14 +90,62 @@ class TestPublisher(object):
     Updated to ensure 4-way cycle markets are always in same order
       e.g.  always CAD/EUR, not sometimes EUR/CAD
     """
-    def __init__(self):
-        self.subscriptions = {}
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def __init__(self, changed_only=False, fanout=None, verbose=False, stats_address=None, stats_interval=None):
+        """
+        :param changed_only: in version 2 messages, leave out quotes whose price
+                             hasn't changed since it was last sent (up to REFRESH_MICROS)
+        :param fanout: FanOut to send with, e.g. FanOut(sockets=4) or
+                       FanOut(multicast_group=('239.1.1.1', 50404)) (default sends
+                       in batches from one socket)
+        :param verbose: print each tick's quotes and what was done with them
+        :param stats_address: (host, port) to answer metrics requests on (see fxp_metrics)
+        :param stats_interval: seconds between printing the metrics (default never)
+        """
+        self.subscriptions = {}  # subscriber -> when their lease runs out, in epoch micros
+        self.leases = []  # heap of (lease expiry in epoch micros, subscriber), soonest first
+        self.group_keys = {}  # subscriber -> (message version, market filter or None, max rate or None) they asked for
+        self.groups = {}  # group key -> {subscriber: None}, in order of subscription
+        self.fanout = fanout if fanout is not None else FanOut()
+        self.verbose = verbose
         self.reference = {'GBP': 1.25, 'JPY': 100.0, 'EUR': 1.10, 'CHF': 1.00, 'AUD': 0.75}
+        self.changed_only = changed_only
+        self.last_sent = {}  # group key -> {market id: (price, time sent in epoch micros)}, for changed_only
+        self.conflators = {}  # group key -> Conflator, for groups with a max rate
+        self.skipped_updates = 0  # times a rate-limited subscriber was sent nothing on a tick
+        self.conflated_updates = 0  # updates a rate-limited subscriber never got because a later price replaced it
+        self.metrics = ProviderMetrics()
+        self.metrics.gauges.update(subscribers=lambda: len(self.subscriptions),
+                                   subscriber_groups=lambda: len(self.groups),
+                                   skipped_updates=lambda: self.skipped_updates,
+                                   conflated_updates=lambda: self.conflated_updates)
+        if stats_address is not None or stats_interval:
+            MetricsReporter(self.metrics, stats_address, stats_interval)
+
+    def register_subscription(self, subscriber, version=fxp_bytes.VERSION_1, lease_time=SUBSCRIPTION_TIME,
+                              markets=None, max_rate=None):
+        """
+        Start or renew a subscriber's lease.
 
-    def register_subscription(self, subscriber):
-        print('registering subscription for {}'.format(subscriber))
-        self.subscriptions[subscriber] = datetime.utcnow()
+        :param subscriber: (ip address, port) to publish to
+        :param version: message version to send them
+        :param lease_time: seconds until the subscription lapses unless renewed
+        :param markets: frozenset of the market ids they want (default all)
+        :param max_rate: most messages a second they want; in between, updates
+                         are conflated to the latest price for each market
+                         (default is every tick)
+        """
+        if self.verbose:
+            print('registering subscription for {} (version {})'.format(subscriber, version))
+        expiry = fxp_bytes.now_micros() + round(lease_time * fxp_bytes.MICROS_PER_SECOND)
+        self.subscriptions[subscriber] = expiry
+        heapq.heappush(self.leases, (expiry, subscriber))  # any earlier lease entry is left to be skipped
+        key = (version, markets or None, max_rate or None)
+        previous = self.group_keys.get(subscriber)
+        if previous != key:
+            if previous is not None:
+                self.leave_group(subscriber, previous)
+            self.groups.setdefault(key, {})[subscriber] = None
+            self.group_keys[subscriber] = key
 
     @staticmethod
     # ensure market names always in correct order, alpha sort e.g. CAD/EUR
@@ -46,33 +160,44 @@ class TestPublisher(object):
 
     def publish(self):
         # remove expired subscriptions
-        ts = datetime.utcnow()
-        for subscriber in set(self.subscriptions):
-            if (ts - self.subscriptions[subscriber]).total_seconds() >= SUBSCRIPTION_TIME:
-                print('{} subscription expired'.format(subscriber))
-                del self.subscriptions[subscriber]
+        started = time.perf_counter()
+        now = fxp_bytes.now_micros()
+        self.expire_subscriptions(now)
         if len(self.subscriptions) == 0:
-            print('no subscriptions')
+            if self.verbose:
+                print('no subscriptions')
             return 1000.0  # nothing to do until we get a subscription, so we can wait a long time
 
+        self.send_quotes(self.next_quotes(now), now)
+        self.record_tick(started)
+
+        # pick a time to wait until the next message
+        return 1.0  # FIXME randomize quiet time
+
+    def next_quotes(self, now):
+        """
+        Move the market on and make up the quotes for this tick.
+
+        :param now: current time in epoch micros
+        :return: list of fxp_bytes.Quote
+        """
         # random walk the prices
         quotes = []
         for ccy in self.reference:
             self.reference[ccy] *= max(0.9, random.gauss(1.0, 0.0001))
             self.reference[ccy] = round(self.reference[ccy], 5)
             if ccy in REVERSE_QUOTED:
-                quote = {'cross': ccy + '/USD'}
+                market = fxp_bytes.market_id(ccy + '/USD')
             else:
-                quote = {'cross': 'USD/' + ccy}
-            quote['price'] = self.reference[ccy]
-            quotes.append(quote)
+                market = fxp_bytes.market_id('USD/' + ccy)
+            quotes.append(fxp_bytes.Quote(market, self.reference[ccy], now))
 
         # occasionally put in some older timestamps to simulate out-of-order UDP messages
         if random.random() < 0.10: # 10% of the time
-            print('sending an out of order message')
-            ts -= timedelta(seconds=random.gauss(10, 3), microseconds=random.gauss(200, 10))
-            for quote in quotes:
-                quote['time'] = ts
+            if self.verbose:
+                print('sending an out of order message')
+            ts = now - round(random.gauss(10, 3) * fxp_bytes.MICROS_PER_SECOND + random.gauss(200, 10))
+            quotes = [quote._replace(micros=ts) for quote in quotes]
 
         # perhaps take out some of the reference crosses and mix them up
         quotes = random.sample(quotes, k=len(quotes) - random.choice((0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 2, 3)))
@@ -84,23 +209,166 @@ class TestPublisher(object):
             yyy_per_usd = self.reference[yyy] if yyy not in REVERSE_QUOTED else 1/self.reference[yyy]
             rate = (yyy_per_usd / xxx_per_usd) * random.gauss(1.0, 0.01)
             if random.random() < 0.5:
-                print('putting in a 3-way cycle')
-                quotes.append({'cross': '{}/{}'.format(xxx, yyy), 'price': rate})
+                if self.verbose:
+                    print('putting in a 3-way cycle')
+                quotes.append(fxp_bytes.Quote(fxp_bytes.market_id((xxx, yyy)), rate, now))
             else:
-                print('putting in a 4-way cycle - v2')
+                if self.verbose:
+                    print('putting in a 4-way cycle - v2')
                 market_name = TestPublisher.format_market_order("CAD",xxx)
-                quotes.append({'cross': '{}'.format(market_name), 'price': rate/2})
+                quotes.append(fxp_bytes.Quote(fxp_bytes.market_id(market_name), rate/2, now))
                 market_name = TestPublisher.format_market_order("CAD",yyy)
-                quotes.append({'cross': '{}'.format(market_name), 'price': rate*2})
+                quotes.append(fxp_bytes.Quote(fxp_bytes.market_id(market_name), rate*2, now))
+        return quotes
 
-        # send the messages to current subscribers
-        message = fxp_bytes.marshal_message(quotes)
-        for subscriber in self.subscriptions:
-            print('publishing {} to {}'.format(quotes, subscriber))
-            self.socket.sendto(message, subscriber)
+    def send_quotes(self, quotes, now):
+        """
+        Send the quotes to current subscribers.
 
-        # pick a time to wait until the next message
-        return 1.0  # FIXME randomize quiet time
+        :param quotes: list of fxp_bytes.Quote
+        :param now: current time in epoch micros
+        """
+        # send the messages to current subscribers, marshalled once for each version, filter and max rate
+        # asked for; subscribers sharing a max rate are sent to together, so they also share the marshalling
+        if not self.groups:
+            return
+        if self.fanout.multicast_group is not None:
+            # everyone in the multicast group gets the one message, so all quotes in the oldest version
+            version = min(key[0] for key in self.groups)
+            groups = [((version, None, None), [])]
+        else:
+            groups = [(key, list(group)) for key, group in self.groups.items() if group]
+        for key, subscribers in groups:
+            version, markets, max_rate = key
+            group_quotes = quotes if markets is None else [quote for quote in quotes if quote.market in markets]
+            if max_rate is not None:
+                conflator = self.conflators.get(key)
+                if conflator is None:
+                    conflator = self.conflators[key] = Conflator(max_rate)
+                group_quotes, conflated = conflator.offer(group_quotes, now)
+                self.conflated_updates += conflated * len(subscribers)
+                if group_quotes is None:
+                    self.skipped_updates += len(subscribers)
+                    continue
+            if not group_quotes:
+                continue
+            marshal_started = time.perf_counter()
+            messages = self.marshal(group_quotes, version, now, key)
+            if not messages:
+                continue
+            send_started = time.perf_counter()
+            sent = 0
+            for message in messages:
+                count = self.fanout.send(message, subscribers, key)
+                sent += count
+                self.metrics.bytes += count * len(message)
+            self.metrics.datagrams += sent
+            self.metrics.marshal.record((send_started - marshal_started) * 1e6)
+            self.metrics.send.record((time.perf_counter() - send_started) * 1e6)
+            if self.verbose:
+                print('publishing {} as {} datagrams to {} version {} subscribers'.format(
+                    [quote.as_dict() for quote in group_quotes], sent, len(subscribers), version))
+
+    def record_tick(self, started):
+        """
+        :param started: time.perf_counter() when the tick began
+        """
+        self.metrics.ticks += 1
+        self.metrics.tick.record((time.perf_counter() - started) * 1e6)
+
+    def leave_group(self, subscriber, key):
+        group = self.groups[key]
+        del group[subscriber]
+        if not group:
+            del self.groups[key]
+            self.last_sent.pop(key, None)
+            self.conflators.pop(key, None)
+            self.fanout.forget(key)
+
+    def expire_subscriptions(self, now):
+        """
+        Drop the subscriptions whose leases have run out. Only the lease heap
+        entries that are due get looked at; one whose subscriber has renewed
+        since is just discarded.
+
+        >>> publisher = TestPublisher()
+        >>> publisher.register_subscription(('127.0.0.1', 50501), lease_time=10)
+        >>> first_lease = publisher.subscriptions[('127.0.0.1', 50501)]
+        >>> publisher.register_subscription(('127.0.0.1', 50501), lease_time=20)  # renewed
+        >>> publisher.expire_subscriptions(first_lease)  # the first lease has run out, but not the renewal
+        >>> list(publisher.subscriptions), list(publisher.groups), len(publisher.leases)
+        ([('127.0.0.1', 50501)], [(1, None, None)], 1)
+        >>> publisher.expire_subscriptions(publisher.subscriptions[('127.0.0.1', 50501)])
+        >>> publisher.subscriptions, publisher.groups, publisher.metrics.expirations
+        ({}, {}, 1)
+
+        :param now: current time in epoch micros
+        """
+        leases = self.leases
+        while leases and leases[0][0] <= now:
+            expiry, subscriber = heapq.heappop(leases)
+            if self.subscriptions.get(subscriber) == expiry:
+                if self.verbose:
+                    print('{} subscription expired'.format(subscriber))
+                del self.subscriptions[subscriber]
+                self.leave_group(subscriber, self.group_keys.pop(subscriber))
+                self.metrics.expirations += 1
+
+    def marshal(self, quotes, version, now, key=None):
+        """
+        Marshal the quotes in the given message version.
+        Quotes are split over as many messages as it takes. Version 2 can only
+        carry the markets in fxp_bytes.V2_MARKETS, so quotes for any others
+        go to version 2 subscribers in version 1 messages, which they also
+        understand.
+
+        >>> now = fxp_bytes.now_micros()
+        >>> quotes = [fxp_bytes.Quote(fxp_bytes.market_id(cross), 1.5, now) for cross in ('GBP/USD', 'ABC/USD')]
+        >>> [message[0] for message in TestPublisher().marshal(quotes, fxp_bytes.VERSION_2, now)]  # 'A' of ABCUSD, then v2
+        [65, 2]
+        >>> TestPublisher().marshal(quotes[:1], 0, now)[0][:3]  # an unknown version gets version 1
+        b'GBP'
+        >>> publisher = TestPublisher(changed_only=True)
+        >>> [len(publisher.marshal(quotes[:1], fxp_bytes.VERSION_2, now + i)) for i in range(2)]  # unchanged: nothing
+        [1, 0]
+
+        :param quotes: list of fxp_bytes.Quote
+        :param version: fxp_bytes.VERSION_1 or VERSION_2 (anything older than
+                        version 2 gets version 1)
+        :param now: current time in epoch micros
+        :param key: subscriber group the messages are for, which changed_only
+                    keeps track of separately
+        :return: list of byte streams, one per UDP message
+        """
+        if version < fxp_bytes.VERSION_2:
+            size = fxp_bytes.MAX_QUOTES_PER_MESSAGE
+            if len(quotes) <= size:
+                return [fxp_bytes.marshal_message(quotes)]
+            return fxp_bytes.marshal_messages([quotes[i:i + size] for i in range(0, len(quotes), size)])
+        v2_numbers = fxp_bytes.V2_NUMBERS
+        others = [quote for quote in quotes if quote.market not in v2_numbers]
+        messages = self.marshal(others, fxp_bytes.VERSION_1, now) if others else []
+        quotes = [quote for quote in quotes if quote.market in v2_numbers]
+        if self.changed_only:
+            quotes = self.changed_quotes(quotes, now, self.last_sent.setdefault(key, {}))
+        if not quotes:  # e.g. with changed_only, none has changed
+            return messages
+        size = fxp_bytes.MAX_QUOTES_PER_MESSAGE_V2
+        return messages + [fxp_bytes.marshal_message_v2(quotes[i:i + size]) for i in range(0, len(quotes), size)]
+
+    @staticmethod
+    def changed_quotes(quotes, now, last_sent):
+        """
+        Pick out the quotes with a new price, or whose price was last sent
+        REFRESH_MICROS or more ago, and note them in last_sent as sent.
+        """
+        changed = []
+        for quote in quotes:
+            last = last_sent.get(quote.market)
+            if last is None or last[0] != quote.price or now - last[1] >= REFRESH_MICROS:
+                last_sent[quote.market] = (quote.price, now)
+                changed.append(quote)
+        return changed
 
 
 class ForexProvider(object):
@@ -128,9 +396,11 @@ class ForexProvider(object):
             next_timeout = self.publisher.publish()
 
     def register_subscription(self):
-        data, _address = self.subscription_requests.recvfrom(REQUEST_SIZE)
-        subscriber = fxp_bytes.deserialize_address(data)
-        self.publisher.register_subscription(subscriber)
+        data, address = self.subscription_requests.recvfrom(REQUEST_SIZE)
+        try:
+            register_request(self.publisher, data)
+        except (ValueError, TypeError) as e:  # TypeError: a publisher that can't take the request
+            print('bad subscription request from {}: {}'.format(address, e))
 
     @staticmethod
     def start_a_server(address):
@@ -145,10 +415,310 @@ class ForexProvider(object):
         return listener
 
 
+def register_request(publisher, data):
+    """
+    Pass a subscription request on to the publisher. Plain version 1
+    requests are registered without a version, and anything a publisher's
+    register_subscription has no parameter for is left out (so its
+    subscribers get version 1, every market, every tick), so publishers
+    written before versions and market filters existed keep working.
+
+    >>> class OldPublisher(object):
+    ...     def register_subscription(self, subscriber):
+    ...         print('subscribed', subscriber)
+    >>> register_request(OldPublisher(), b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02\\x01GBPUSD')
+    subscribed ('127.0.0.1', 65534)
+
+    :param publisher: object with a register_subscription method
+    :param data: the request datagram
+    :raises ValueError: if the request is malformed
+    """
+    subscriber, version = fxp_bytes.deserialize_subscription(data)
+    options = {'markets': fxp_bytes.deserialize_market_filter(data),
+               'max_rate': fxp_bytes.deserialize_max_rate(data)}
+    takes_version, keywords = subscription_parameters(publisher.register_subscription)
+    options = {name: value for name, value in options.items()
+               if value is not None and (keywords is None or name in keywords)}
+    if takes_version and (options or version != fxp_bytes.VERSION_1):
+        publisher.register_subscription(subscriber, version, **options)
+    else:
+        publisher.register_subscription(subscriber, **options)
+
+
+def subscription_parameters(register_subscription):
+    """
+    Find out what a publisher's register_subscription can be told besides
+    the subscriber.
+
+    :param register_subscription: the bound method
+    :return: (whether it takes a version after the subscriber, set of the
+             keyword parameter names it takes or None for any at all)
+    """
+    try:
+        parameters = list(inspect.signature(register_subscription).parameters.values())
+    except (TypeError, ValueError):  # e.g. a builtin with no signature; assume the current contract
+        return True, None
+    if any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters):
+        keywords = None
+    else:
+        keywords = {parameter.name for parameter in parameters[2:]
+                    if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY)}
+    positional = [parameter for parameter in parameters
+                  if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD)]
+    takes_version = len(positional) > 1 or any(parameter.kind == parameter.VAR_POSITIONAL for parameter in parameters)
+    return takes_version, keywords
+
+
+class SubscriptionProtocol(asyncio.DatagramProtocol):
+    """
+    Receives subscription requests for an AsyncForexProvider.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def datagram_received(self, data, addr):
+        try:
+            register_request(self.provider.publisher, data[:REQUEST_SIZE])
+        except (ValueError, TypeError) as e:  # TypeError: a publisher that can't take the request
+            print('bad subscription request from {}: {}'.format(addr, e))
+            return
+        self.provider.wakeup.set()
+
+
+class AsyncForexProvider(object):
+    """
+    Same job as ForexProvider, on asyncio. Ticks are scheduled against
+    absolute deadlines on the event loop's monotonic clock, so they don't
+    drift however long each publish takes; a tick that overruns makes the
+    scheduler skip the deadlines already missed rather than bunch up ticks.
+    Publishing only marshals and hands datagrams to the kernel, on
+    non-blocking sockets if the publisher has a FanOut, so no subscriber can
+    hold up a tick.
+    """
+
+    def __init__(self, request_address, publisher_class, tick_interval=None):
+        """
+        :param request_address: where subscription requests arrive
+        :param publisher_class: publisher class must support publish and register_subscription
+        :param tick_interval: seconds between ticks, e.g. 0.001; default is to
+                              wait however long each publish() asks for
+        """
+        self.request_address = request_address
+        self.publisher = publisher_class()
+        fanout = getattr(self.publisher, 'fanout', None)
+        if fanout is not None:
+            fanout.setblocking(False)
+        self.tick_interval = tick_interval
+        self.wakeup = None  # asyncio.Event, set when a subscription arrives
+        self.ticks = 0
+        self.missed_ticks = 0
+
+    def run_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        transport, _protocol = await loop.create_datagram_endpoint(
+            lambda: SubscriptionProtocol(self), local_addr=self.request_address)
+        print('waiting for subscribers on {} (asyncio)'.format(self.request_address))
+        try:
+            await self.tick_forever()
+        finally:
+            transport.close()
+
+    async def tick_forever(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            self.wakeup.clear()
+            wait = self.publisher.publish()
+            self.ticks += 1
+            if wait >= IDLE_WAIT:
+                # nobody to publish to: sleep until someone subscribes, then start ticking again from then
+                await self.wait_for_wakeup(wait)
+                deadline = loop.time()
+                continue
+
+            interval = self.tick_interval if self.tick_interval is not None else wait
+            deadline += interval
+            late = loop.time() - deadline
+            if late > 0:
+                missed = math.ceil(late / interval) if interval > 0 else 0
+                self.missed_ticks += missed
+                deadline += missed * interval
+            await asyncio.sleep(deadline - loop.time())
+
+    async def wait_for_wakeup(self, timeout):
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def publish_shard(connection, publisher_class):
+    """
+    Worker process of a ShardedForexProvider: keeps its share of the
+    subscriptions and sends each tick's quotes to them.
+
+    :param connection: pipe from the coordinator, carrying ('subscribe', request, None)
+                       and ('tick', [(6-byte market code, price, epoch micros), ...], now)
+    :param publisher_class: publisher class, as given to the coordinator
+    """
+    publisher = publisher_class()
+    while True:
+        try:
+            kind, payload, now = connection.recv()
+        except EOFError:
+            return  # coordinator has gone
+        if kind == 'subscribe':
+            try:
+                register_request(publisher, payload)
+            except (ValueError, TypeError) as e:  # TypeError: a publisher that can't take the request
+                print('bad subscription request {}: {}'.format(bytes(payload[:8]), e))
+        else:
+            # market ids are only good within a process, so they travel as codes
+            started = time.perf_counter()
+            quotes = [fxp_bytes.Quote(fxp_bytes.market_id(code), price, micros) for code, price, micros in payload]
+            publisher.expire_subscriptions(now)
+            publisher.send_quotes(quotes, now)
+            publisher.record_tick(started)
+
+
+class ShardedForexProvider(object):
+    """
+    ForexProvider spread over several processes. The coordinator takes the
+    subscription requests and makes up each tick's quotes once; every worker
+    process owns a share of the subscribers and does its own marshalling and
+    sending, so fan-out runs on as many cores as there are workers.
+
+    Subscribers are assigned to workers by a hash of their address, so a
+    renewal goes to the worker that already has the subscription (with
+    SO_REUSEPORT the kernel would pick by the request's source port, which
+    changes from one renewal to the next).
+
+    A worker that dies is replaced by a new one the next time it is sent
+    something. Its subscribers are lost until they renew, which puts them
+    back on the new worker.
+
+    The metrics are counted by the workers, each reporting its own with the
+    publisher's stats options; the coordinator's publisher sends nothing, so
+    it is made without any.
+    """
+
+    def __init__(self, request_address, publisher_class, workers=None, tick_interval=1.0):
+        """
+        :param request_address: where subscription requests arrive
+        :param publisher_class: publisher class must support next_quotes, send_quotes, record_tick,
+                                expire_subscriptions and register_subscription, take
+                                stats_address and stats_interval keywords, and be
+                                picklable (e.g. a class or functools.partial)
+        :param workers: number of worker processes (default one per core)
+        :param tick_interval: seconds between ticks
+        """
+        self.selector = selectors.DefaultSelector()
+        self.subscription_requests = ForexProvider.start_a_server(request_address)
+        self.selector.register(self.subscription_requests, selectors.EVENT_READ)
+        self.publisher = publisher_class(stats_address=None, stats_interval=None)  # only makes up the quotes
+        self.publisher_class = publisher_class
+        self.tick_interval = tick_interval
+        self.connections = []
+        self.workers = []
+        for shard in range(workers or multiprocessing.cpu_count()):
+            self.start_worker(shard)
+
+    def start_worker(self, shard):
+        """
+        Start the worker process for a shard, in place of any earlier one.
+        """
+        ours, theirs = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=publish_shard, args=(theirs, self.publisher_class), daemon=True)
+        worker.start()
+        theirs.close()
+        if shard < len(self.workers):
+            self.connections[shard].close()
+            self.workers[shard].join(timeout=0)  # reap it
+            self.connections[shard], self.workers[shard] = ours, worker
+        else:
+            self.connections.append(ours)
+            self.workers.append(worker)
+
+    def send(self, shard, message):
+        """
+        Send a message to a shard's worker, replacing the worker first if it has died.
+
+        :param shard: index of the worker
+        :param message: (kind, payload, now) tuple, already pickled
+        """
+        worker = self.workers[shard]
+        if worker.is_alive():
+            try:
+                self.connections[shard].send_bytes(message)
+                return
+            except OSError:  # e.g. BrokenPipeError, if it died since is_alive()
+                pass
+        print('worker {} (pid {}) died with exit code {}; starting another'.format(
+            shard, worker.pid, worker.exitcode))
+        self.start_worker(shard)
+        self.connections[shard].send_bytes(message)
+
+    def run_forever(self):
+        print('waiting for subscribers on {} with {} workers'.format(self.subscription_requests, len(self.workers)))
+        deadline = time.monotonic()
+        while True:
+            events = self.selector.select(max(0.0, deadline - time.monotonic()))
+            for key, mask in events:
+                self.register_subscription()
+            if time.monotonic() >= deadline:
+                self.tick()
+                deadline += self.tick_interval
+                late = time.monotonic() - deadline
+                if late > 0:  # skip the ticks we've missed rather than bunch them up
+                    deadline += math.ceil(late / self.tick_interval) * self.tick_interval
+
+    def register_subscription(self):
+        data, _address = self.subscription_requests.recvfrom(REQUEST_SIZE)
+        shard = zlib.crc32(data[:6]) % len(self.connections)  # the subscriber's address
+        self.send(shard, pickle.dumps(('subscribe', data, None), pickle.HIGHEST_PROTOCOL))
+
+    def tick(self):
+        now = fxp_bytes.now_micros()
+        payload = [(fxp_bytes.MARKETS[market], price, micros) for market, price, micros in self.publisher.next_quotes(now)]
+        message = pickle.dumps(('tick', payload, now), pickle.HIGHEST_PROTOCOL)  # once for every worker
+        for shard in range(len(self.connections)):
+            self.send(shard, message)
+
+
 if __name__ == '__main__':
     # if REQUEST_ADDRESS[1] == 50403:
     #     print('Pick your own port for testing!')
     #     print('Modify REQUEST_ADDRESS above to use localhost and some random port')
     #     exit(1)
-    fxp = ForexProvider(REQUEST_ADDRESS, TestPublisher)
+    parser = argparse.ArgumentParser(description='Forex Provider price feed on localhost')
+    parser.add_argument('--asyncio', action='store_true', help='run the asyncio provider')
+    parser.add_argument('--workers', type=int, default=None, help='run the sharded provider with this many processes')
+    parser.add_argument('--tick', type=float, default=None,
+                        help='seconds between ticks with --asyncio or --workers, e.g. 0.001 (default 1 s)')
+    parser.add_argument('--simulate', type=int, default=None, metavar='CURRENCIES',
+                        help='publish a simulated market of this many currencies (needs NumPy)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for --simulate')
+    parser.add_argument('--verbose', action='store_true', help='print every tick and subscription')
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help='answer metrics requests on this UDP port (not with --workers)')
+    parser.add_argument('--stats-interval', type=float, default=None, help='print metrics every this many seconds')
+    args = parser.parse_args()
+    options = dict(verbose=args.verbose, stats_interval=args.stats_interval)
+    if args.stats_port and not args.workers:
+        options['stats_address'] = (REQUEST_ADDRESS[0], args.stats_port)
+    publisher_class = functools.partial(TestPublisher, **options)
+    if args.simulate:
+        from forex_simulator import SimulatedPublisher  # needs NumPy, so only imported if asked for
+        publisher_class = functools.partial(SimulatedPublisher, currencies=args.simulate, seed=args.seed, **options)
+    if args.workers:
+        fxp = ShardedForexProvider(REQUEST_ADDRESS, publisher_class, args.workers, args.tick or 1.0)
+    elif args.asyncio:
+        fxp = AsyncForexProvider(REQUEST_ADDRESS, publisher_class, args.tick)
+    else:
+        fxp = ForexProvider(REQUEST_ADDRESS, publisher_class)
     fxp.run_forever()
@@ -0,0 +1,110 @@
+"""
+Large-universe market simulator for load testing the Forex Provider.
+
+Random-walks thousands of currencies against USD in one NumPy step per
+tick, from a seed, with configurable out-of-order, drop and arbitrage
+rates. Requires NumPy.
+
+run python3 forex_provider.py --simulate 2000 --seed 5520 --tick 0.01 --workers 4
+"""
+import itertools
+import string
+
+import numpy as np
+
+import fxp_bytes
+from forex_provider import REVERSE_QUOTED, TestPublisher
+
+
+class SimulatedPublisher(TestPublisher):
+    """
+    TestPublisher whose quotes come from a simulated market of any size.
+    Each tick quotes every currency against USD (less any dropped), split
+    over as many datagrams as needed, and now and then adds a cross-currency
+    cycle priced to be profitable. The currencies of fxp_bytes.V2_CURRENCIES
+    come first, so a small market goes out in compact version 2 messages;
+    made-up ones (AAA, AAB, ...) make up the rest, and version 2
+    subscribers get their quotes in version 1 messages.
+
+    >>> a = SimulatedPublisher(currencies=50, seed=1, verbose=False)
+    >>> b = SimulatedPublisher(currencies=50, seed=1, verbose=False)
+    >>> a.next_quotes(0) == b.next_quotes(0)
+    True
+    >>> c = SimulatedPublisher(currencies=181, verbose=False)
+    >>> now = fxp_bytes.now_micros()
+    >>> quotes = c.next_quotes(now)
+    >>> len(c.marshal(quotes, fxp_bytes.VERSION_1, now))  # 180 USD crosses, maybe a cycle
+    4
+    >>> import fxp_bytes_subscriber
+    >>> messages = c.marshal(quotes, fxp_bytes.VERSION_2, now)
+    >>> sum(len(fxp_bytes_subscriber.unmarshal_quotes(m)) for m in messages) == len(quotes)
+    True
+    """
+
+    def __init__(self, currencies=1000, seed=None, out_of_order=0.10, drop=0.0, cycle_length=3,
+                 arbitrage=0.05, arbitrage_edge=0.01, volatility=0.0001, **kwargs):
+        """
+        :param currencies: size of the market, including USD
+        :param seed: random seed, for repeatable runs
+        :param out_of_order: fraction of quotes sent with a timestamp ~10 s old
+        :param drop: fraction of quotes left out of each tick
+        :param cycle_length: number of currencies in an injected arbitrage cycle
+        :param arbitrage: fraction of ticks with an arbitrage cycle injected
+        :param arbitrage_edge: profit on one trip around an injected cycle
+        :param volatility: standard deviation of each tick's log price move
+        :param kwargs: passed on to TestPublisher
+        """
+        super().__init__(**kwargs)
+        self.rng = np.random.default_rng(seed)
+        made_up = (''.join(letters) for letters in itertools.product(string.ascii_uppercase, repeat=3))
+        codes = itertools.chain(fxp_bytes.V2_CURRENCIES,
+                                (code for code in made_up if code not in fxp_bytes.V2_CURRENCIES))
+        self.currencies = list(itertools.islice((code for code in codes if code != 'USD'), currencies - 1))
+        self.rates = np.exp(self.rng.normal(0.0, 2.0, len(self.currencies)))  # units per USD
+        self.reverse = np.array([ccy in REVERSE_QUOTED for ccy in self.currencies])
+        self.market_ids = np.array([fxp_bytes.market_id((ccy, 'USD') if reverse else ('USD', ccy))
+                                    for ccy, reverse in zip(self.currencies, self.reverse)])
+        self.out_of_order = out_of_order
+        self.drop = drop
+        self.cycle_length = cycle_length
+        self.arbitrage = arbitrage
+        self.arbitrage_edge = arbitrage_edge
+        self.volatility = volatility
+
+    def next_quotes(self, now):
+        rng, n = self.rng, len(self.rates)
+        self.rates *= np.exp(rng.normal(0.0, self.volatility, n))
+        prices = np.where(self.reverse, 1 / self.rates, self.rates)
+
+        times = np.full(n, now, dtype=np.int64)
+        late = rng.random(n) < self.out_of_order
+        ages = np.maximum(rng.normal(10, 3, int(late.sum())), 0) * fxp_bytes.MICROS_PER_SECOND
+        times[late] -= ages.astype(np.int64)
+
+        keep = rng.random(n) >= self.drop
+        quotes = list(map(fxp_bytes.Quote, self.market_ids[keep].tolist(), prices[keep].tolist(),
+                          times[keep].tolist()))
+        if rng.random() < self.arbitrage:
+            quotes.extend(self.arbitrage_cycle(now))
+        return quotes
+
+    def arbitrage_cycle(self, now):
+        """
+        Quotes around a cycle of random currencies, fair except for the last
+        leg, which is off by arbitrage_edge.
+
+        :param now: current time in epoch micros
+        :return: list of fxp_bytes.Quote, one per leg
+        """
+        members = self.rng.choice(len(self.currencies), size=self.cycle_length, replace=False).tolist()
+        if self.verbose:
+            print('putting in a {}-way cycle'.format(self.cycle_length))
+        quotes = []
+        for i, (a, b) in enumerate(zip(members, members[1:] + members[:1])):
+            if self.currencies[a] > self.currencies[b]:
+                a, b = b, a  # market names always in alphabetical order
+            price = float(self.rates[b] / self.rates[a])
+            if i == len(members) - 1:
+                price *= 1 + self.arbitrage_edge
+            quotes.append(fxp_bytes.Quote(fxp_bytes.market_id((self.currencies[a], self.currencies[b])), price, now))
+        return quotes
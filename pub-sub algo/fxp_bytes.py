@@ -5,11 +5,130 @@ Forex Provider
 This module contains useful marshalling functions for manipulating Forex Provider packet contents.
 """
 import ipaddress
+import struct
+import time
 from array import array
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import NamedTuple
 
 MAX_QUOTES_PER_MESSAGE = 50
 MICROS_PER_SECOND = 1_000_000
+# market, price (native float as from serialize_price), serialized time, 14 bytes of zero-padding
+QUOTE_RECORD = struct.Struct('=6sf8s14x')
+QUOTE_SIZE = QUOTE_RECORD.size
+EPOCH = datetime(1970, 1, 1)
+
+# interned markets: a market's id is its index in MARKETS (6-byte wire code)
+# and in MARKET_PAIRS ((base, quote) currency names)
+MARKETS = []
+MARKET_PAIRS = []
+MARKET_IDS = {}  # wire code, 'XXX/YYY' cross or (base, quote) pair -> id
+MAX_MARKETS = 65536  # subscription requests can't add markets beyond this many
+
+
+def market_id(market) -> int:
+    """
+    Get the interned id of a market, adding it to the table if it is new.
+
+    >>> market_id('GBP/USD') == market_id(b'GBPUSD') == market_id(('GBP', 'USD'))
+    True
+    >>> MARKETS[market_id('GBP/USD')], MARKET_PAIRS[market_id('GBP/USD')]
+    (b'GBPUSD', ('GBP', 'USD'))
+
+    :param market: 'XXX/YYY' cross, 6-byte wire code, or (base, quote) pair
+    :return: small integer that names the market within this process
+    """
+    mid = MARKET_IDS.get(market)
+    if mid is None:
+        if isinstance(market, str):
+            pair = (market[0:3], market[4:7])
+        elif isinstance(market, tuple):
+            pair = market
+        else:
+            pair = (market[0:3].decode('ascii'), market[3:6].decode('ascii'))
+        code = (pair[0] + pair[1]).encode('ascii')
+        mid = MARKET_IDS.get(code)
+        if mid is None:
+            mid = len(MARKETS)
+            MARKETS.append(code)
+            MARKET_PAIRS.append(pair)
+            MARKET_IDS[code] = MARKET_IDS['/'.join(pair)] = MARKET_IDS[pair] = mid
+        MARKET_IDS[market] = mid
+    return mid
+
+
+# version 2 messages: a header, then a short record per quote, markets
+# numbered by their place in V2_MARKETS, which both ends agree on
+VERSION_1 = 1  # has no header; the first byte is a letter of the first market
+VERSION_2 = 2
+V2_HEADER = struct.Struct('>BBq')  # version, quote count, base time in epoch micros
+V2_RECORD = struct.Struct('>BfI')  # market number, price, micros after the base time
+MAX_QUOTES_PER_MESSAGE_V2 = 150  # fits in the same datagram as MAX_QUOTES_PER_MESSAGE version 1 quotes
+V2_CURRENCIES = ('AUD', 'CAD', 'CHF', 'CNY', 'EUR', 'GBP', 'HKD', 'JPY',
+                 'KRW', 'MXN', 'NOK', 'NZD', 'SEK', 'SGD', 'USD', 'ZAR')
+V2_MARKETS = tuple('{}/{}'.format(a, b) for a in V2_CURRENCIES for b in V2_CURRENCIES if a != b)
+
+
+def now_micros() -> int:
+    """
+    Current UTC time as integer microseconds since 00:00:00 UTC on 1 January 1970.
+    """
+    return time.time_ns() // 1000
+
+
+def epoch_micros(utc: datetime) -> int:
+    """
+    Convert a naive UTC datetime to integer microseconds since the epoch.
+
+    >>> epoch_micros(datetime(1971, 12, 10, 1, 2, 3, 64000))
+    61174923064000
+
+    :param utc: timestamp to convert
+    :return: microseconds since 00:00:00 UTC on 1 January 1970
+    """
+    return (utc - EPOCH) // timedelta(microseconds=1)
+
+
+class Quote(NamedTuple):
+    """
+    One price quote as passed between the publisher, the wire format and the
+    subscriber: an interned market id (see market_id), the price, and the
+    quote time in microseconds since the epoch. Dictionaries and datetimes
+    are only built at the edges, for printing and for older callers.
+
+    >>> q = Quote.from_dict({'cross': 'GBP/USD', 'price': 1.25, 'time': datetime(2006, 1, 2)})
+    >>> q.cross, q.price, q.micros
+    ('GBP/USD', 1.25, 1136160000000000)
+    >>> q.as_dict() == {'cross': 'GBP/USD', 'price': 1.25, 'time': datetime(2006, 1, 2)}
+    True
+    """
+    market: int
+    price: float
+    micros: int
+
+    @classmethod
+    def from_dict(cls, quote, default_micros=None):
+        """
+        :param quote: quote structure ('cross' and 'price', may also have 'time')
+        :param default_micros: time for a quote without one (default is now)
+        """
+        utc = quote.get('time')
+        if utc is not None:
+            micros = epoch_micros(utc)
+        else:
+            micros = now_micros() if default_micros is None else default_micros
+        return cls(market_id(quote['cross']), quote['price'], micros)
+
+    @property
+    def cross(self) -> str:
+        return '{}/{}'.format(*MARKET_PAIRS[self.market])
+
+    @property
+    def time(self) -> datetime:
+        return EPOCH + timedelta(microseconds=self.micros)
+
+    def as_dict(self) -> dict:
+        return {'cross': self.cross, 'price': self.price, 'time': self.time}
 
 
 def serialize_price(x: float) -> bytes:
@@ -44,6 +163,93 @@ def deserialize_address(b: bytes) -> (str, int):
     return str(ip), p[0]
 
 
+# market id -> V2_MARKETS number, and the reverse
+V2_NUMBERS = {market_id(cross): number for number, cross in enumerate(V2_MARKETS)}
+V2_MARKET_IDS = [market_id(cross) for cross in V2_MARKETS]
+
+
+def deserialize_subscription(b: bytes) -> ((str, int), int):
+    """
+    Get the address to publish to and the newest message version the
+    subscriber understands. Requests from older subscribers are just the
+    6-byte address, or that padded with zeros to the old 12-byte request
+    size, so those only get version 1.
+
+    >>> deserialize_subscription(b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02')
+    (('127.0.0.1', 65534), 2)
+    >>> deserialize_subscription(b'\\x7f\\x00\\x00\\x01\\xff\\xfe')
+    (('127.0.0.1', 65534), 1)
+    >>> deserialize_subscription(b'\\x7f\\x00\\x00\\x01\\xff\\xfe' + bytes(6))
+    (('127.0.0.1', 65534), 1)
+
+    :param b: subscription request
+    :return: (ip address and port pair, message version)
+    """
+    version = b[6] if len(b) > 6 else VERSION_1
+    return deserialize_address(b), max(VERSION_1, min(version, VERSION_2))
+
+
+def deserialize_market_filter(b: bytes) -> frozenset:
+    """
+    Get the markets a subscriber wants, if it said. After the address and
+    version, a request may carry a count byte and that many 6-byte market
+    codes; with none (or a count of zero) the subscriber wants every market.
+    A code must be six capital letters, since it comes off the network and
+    a new one is added to MARKETS (but no more than MAX_MARKETS of them).
+
+    >>> deserialize_market_filter(b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02\\x01GBPUSD') == {market_id('GBP/USD')}
+    True
+    >>> deserialize_market_filter(b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02') is None
+    True
+    >>> deserialize_market_filter(b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02\\x01GBP\\xffSD')
+    Traceback (most recent call last):
+      ...
+    ValueError: b'GBP\\xffSD' is not a market
+
+    :param b: subscription request
+    :return: frozenset of market ids, or None for all markets
+    :raises ValueError: if the filter is cut short or has a bad code
+    """
+    if len(b) < 8 or b[7] == 0:
+        return None
+    codes = bytes(b[8:8 + 6 * b[7]])
+    if len(codes) < 6 * b[7]:
+        raise ValueError('market filter cut short')
+    markets = set()
+    for i in range(0, len(codes), 6):
+        code = codes[i:i + 6]
+        market = MARKET_IDS.get(code)
+        if market is None:
+            if not (code.isalpha() and code.isupper()):  # bytes methods, so ASCII only
+                raise ValueError('{} is not a market'.format(code))
+            if len(MARKETS) >= MAX_MARKETS:
+                raise ValueError('too many markets to add {}'.format(code))
+            market = market_id(code)
+        markets.add(market)
+    return frozenset(markets)
+
+
+def deserialize_max_rate(b: bytes) -> int:
+    """
+    Get the most messages a second a subscriber wants, if it said: two
+    big-endian bytes after the market filter (whose count may be zero).
+
+    >>> deserialize_max_rate(b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02\\x00\\x00\\x05')
+    5
+    >>> deserialize_max_rate(b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02') is None
+    True
+
+    :param b: subscription request
+    :return: messages per second, or None for no limit
+    """
+    if len(b) < 8:
+        return None
+    start = 8 + 6 * b[7]
+    if len(b) < start + 2:
+        return None
+    return int.from_bytes(b[start:start + 2], 'big') or None
+
+
 def serialize_utcdatetime(utc: datetime) -> bytes:
     """
     Convert a UTC datetime into a byte stream for a Forex Provider message.
@@ -56,11 +262,20 @@ def serialize_utcdatetime(utc: datetime) -> bytes:
     :param utc: timestamp to convert to desired byte format
     :return: 8-byte stream
     """
-    epoch = datetime(1970, 1, 1)
-    micros = (utc - epoch).total_seconds() * MICROS_PER_SECOND
-    a = array('Q', [int(micros)])
-    a.byteswap()  # convert to big-endian
-    return a.tobytes()
+    return serialize_micros(epoch_micros(utc))
+
+
+def serialize_micros(micros: int) -> bytes:
+    """
+    Like serialize_utcdatetime, for a time already in microseconds since the epoch.
+
+    >>> serialize_micros(61174923064000)
+    b'\\x00\\x007\\xa3e\\x8e\\xf2\\xc0'
+
+    :param micros: microseconds since 00:00:00 UTC on 1 January 1970
+    :return: 8-byte stream
+    """
+    return micros.to_bytes(8, 'big')
 
 
 def marshal_message(quote_sequence) -> bytes:
@@ -83,21 +298,136 @@ def marshal_message(quote_sequence) -> bytes:
     >>> r2[18:] == r1[18:]  # second quote's 14 bytes of zero-padding
     True
 
-    :param quote_sequence: list of quote structures ('cross' and 'price', may also have 'timestamp')
+    :param quote_sequence: list of Quotes, or of quote structures ('cross' and 'price', may also have 'time')
     :return: byte stream to send in UDP message
     """
     if len(quote_sequence) > MAX_QUOTES_PER_MESSAGE:
         raise ValueError('max quotes exceeded for a single message')
-    message = bytes()
-    default_time = serialize_utcdatetime(datetime.utcnow())
-    padding = b'\x00' * 14  # 10 bytes of zeros
+    message = bytearray(len(quote_sequence) * QUOTE_SIZE)
+    marshal_into(message, quote_sequence)
+    return bytes(message)
+
+
+def marshal_into(buffer, quote_sequence, default_time=None, offset=0) -> int:
+    """
+    Pack the records for quote_sequence straight into buffer, in the same
+    format as marshal_message. Does not check MAX_QUOTES_PER_MESSAGE.
+
+    >>> buffer = bytearray(100)
+    >>> q = {'cross': 'GBP/USD', 'price': 1.22041, 'time': datetime(2006,1,2)}
+    >>> marshal_into(buffer, [q], offset=4)
+    36
+    >>> buffer[4:36] == marshal_message([q])
+    True
+    >>> marshal_message([Quote.from_dict(q)]) == marshal_message([q])
+    True
+
+    :param buffer: writable buffer (e.g. a reusable bytearray) with room for
+                   QUOTE_SIZE bytes per quote after offset
+    :param quote_sequence: list of Quotes, or of quote structures ('cross' and
+                           'price', may also have 'time')
+    :param default_time: serialized time for quotes without one (default is now)
+    :param offset: where in buffer to start
+    :return: offset just past the last record packed
+    """
+    if default_time is None:
+        default_time = serialize_utcdatetime(datetime.utcnow())
+    pack_into = QUOTE_RECORD.pack_into
+    last_time, last_serialized = None, None
     for quote in quote_sequence:
-        message += quote['cross'][0:3].encode('ascii')
-        message += quote['cross'][4:7].encode('ascii')
-        message += serialize_price(quote['price'])
-        if 'time' in quote:
-            message += serialize_utcdatetime(quote['time'])
+        if type(quote) is Quote:
+            market, price, when = quote
+            if when != last_time:  # quotes in a message usually share one time
+                last_serialized = serialize_micros(when)
+                last_time = when
+            pack_into(buffer, offset, MARKETS[market], price, last_serialized)
+            offset += QUOTE_SIZE
+            continue
+        cross = quote['cross']
+        when = quote.get('time')
+        if when is None:
+            serialized = default_time
+        elif when is last_time:
+            serialized = last_serialized
         else:
-            message += default_time
-        message += padding
-    return message
+            serialized = last_serialized = serialize_utcdatetime(when)
+            last_time = when
+        pack_into(buffer, offset, (cross[0:3] + cross[4:7]).encode('ascii'), quote['price'], serialized)
+        offset += QUOTE_SIZE
+    return offset
+
+
+def marshal_messages(quote_batches, buffer=None) -> list:
+    """
+    Marshal several messages at once into one buffer, serializing the
+    default time only once for all of them.
+
+    >>> q1 = {'cross': 'GBP/USD', 'price': 1.22041, 'time': datetime(2006,1,2)}
+    >>> q2 = {'cross': 'USD/JPY', 'price': 108.2755, 'time': datetime(2006,1,1)}
+    >>> m1, m2 = marshal_messages([[q1, q2], [q2]])
+    >>> m1 == marshal_message([q1, q2]), m2 == marshal_message([q2])
+    (True, True)
+
+    :param quote_batches: list of quote sequences, one per message
+    :param buffer: bytearray to reuse between calls; grown if too small
+    :return: list of memoryviews into the buffer, one per message, valid
+             until the buffer is reused
+    """
+    if any(len(batch) > MAX_QUOTES_PER_MESSAGE for batch in quote_batches):
+        raise ValueError('max quotes exceeded for a single message')
+    needed = sum(len(batch) for batch in quote_batches) * QUOTE_SIZE
+    if buffer is None:
+        buffer = bytearray(needed)
+    elif len(buffer) < needed:
+        buffer.extend(bytes(needed - len(buffer)))
+    view = memoryview(buffer)
+    default_time = serialize_utcdatetime(datetime.utcnow())
+    messages = []
+    start = 0
+    for batch in quote_batches:
+        end = marshal_into(buffer, batch, default_time, start)
+        messages.append(view[start:end])
+        start = end
+    return messages
+
+
+def marshal_message_v2(quote_sequence) -> bytes:
+    """
+    Construct a version 2 message: a 10-byte header holding the version, the
+    number of quotes and the earliest quote time, then 9 bytes per quote with
+    the market's number in V2_MARKETS, the price and the quote's offset from
+    the header time in microseconds.
+
+    >>> q1 = Quote(market_id('GBP/USD'), 1.25, 1136160000000000)
+    >>> q2 = Quote(market_id('USD/JPY'), 108.25, 1136160000000250)
+    >>> b = marshal_message_v2([q1, q2])
+    >>> len(b)  # header and two records
+    28
+    >>> b[:10]  # version 2, 2 quotes, time of q1
+    b'\\x02\\x02\\x00\\x04\\tT\\xdd5@\\x00'
+    >>> b[19:]  # USD/JPY is number 217, offset 250 micros
+    b'\\xd9B\\xd8\\x80\\x00\\x00\\x00\\x00\\xfa'
+
+    :param quote_sequence: list of Quotes, or of quote structures ('cross' and
+                           'price', may also have 'time'), for markets in V2_MARKETS
+    :return: byte stream to send in UDP message
+    """
+    if len(quote_sequence) > MAX_QUOTES_PER_MESSAGE_V2:
+        raise ValueError('max quotes exceeded for a single message')
+    if quote_sequence and type(quote_sequence[0]) is not Quote:
+        default_micros = now_micros()
+        quote_sequence = [Quote.from_dict(quote, default_micros) for quote in quote_sequence]
+    base = min((quote.micros for quote in quote_sequence), default=0)
+    message = bytearray(V2_HEADER.size + len(quote_sequence) * V2_RECORD.size)
+    V2_HEADER.pack_into(message, 0, VERSION_2, len(quote_sequence), base)
+    pack_into = V2_RECORD.pack_into
+    offset = V2_HEADER.size
+    try:
+        for market, price, micros in quote_sequence:
+            pack_into(message, offset, V2_NUMBERS[market], price, micros - base)
+            offset += V2_RECORD.size
+    except KeyError:
+        raise ValueError('{} is not a version 2 market'.format(MARKET_PAIRS[market])) from None
+    except struct.error:
+        raise ValueError('quote times too far apart for a version 2 message') from None
+    return bytes(message)
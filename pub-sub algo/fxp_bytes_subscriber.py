@@ -3,6 +3,14 @@ import socket
 import datetime
 from array import array
 
+from fxp_bytes import MARKET_IDS, V2_HEADER, V2_MARKET_IDS, V2_RECORD, VERSION_2, Quote, market_id
+
+QUOTE_SIZE = 32  # Size of quote structure in bytes
+# market, price (native float), time (big-endian on the wire, so byte-swapped after unpacking), padding
+QUOTE_RECORD = struct.Struct("=6sfq14x")
+# same record with the time left as big-endian bytes, for converting one quote at a time
+QUOTE_RECORD_BYTES_TIME = struct.Struct("=6sf8s14x")
+
 def deserialize_price(data: bytes) -> float:
     """
     Deserializes a byte array into a floating-point number.
@@ -32,6 +40,36 @@ def serialize_address(ip, port) -> bytes:
     port_packed = struct.pack("!H", port)  # Packing port to bytes
     return ip_packed + port_packed
 
+def serialize_subscription(ip, port, version=VERSION_2, markets=None, max_rate=None) -> bytes:
+    """
+    Serializes a subscription request: the address to publish to, the
+    newest message version we understand, and optionally the markets we
+    want and how many messages a second at most. Publishers that predate
+    versions only read the address and send version 1 with every market.
+
+    >>> serialize_subscription("127.0.0.1", 65534, 2, ["GBP/USD"])
+    b'\\x7f\\x00\\x00\\x01\\xff\\xfe\\x02\\x01GBPUSD'
+
+    Args:
+        ip (str): The IP address.
+        port (int): The port number.
+        version (int): The message version to ask for.
+        markets (list): Crosses to receive, such as "GBP/USD", at most 255 (default all).
+        max_rate (int): Most messages a second to receive, up to 65535 (default no limit).
+
+    Returns:
+        bytes: The serialized request.
+    """
+    request = serialize_address(ip, port) + bytes([version])
+    if markets or max_rate:
+        markets = markets or []
+        if len(markets) > 255:
+            raise ValueError("at most 255 markets can be asked for")
+        request += bytes([len(markets)]) + "".join(cross[0:3] + cross[4:7] for cross in markets).encode("ascii")
+    if max_rate:
+        request += struct.pack("!H", max_rate)
+    return request
+
 def deserialize_utcdatetime(bytes_data: bytes) -> datetime.datetime:
     """
     Deserializes a bytes object into a datetime.datetime object.
@@ -50,31 +88,123 @@ def deserialize_utcdatetime(bytes_data: bytes) -> datetime.datetime:
     epoch = datetime.datetime(1970, 1, 1)
     return epoch + datetime.timedelta(microseconds=microseconds)
 
-def unmarshal_message(data: bytes) -> list:
+def unmarshal_columns(data) -> (list, array, array):
     """
-    Unmarshals a byte array of quote data into a list of dictionaries.
+    Unmarshals a byte array of quote data into columns, without building a
+    dictionary or datetime per quote. The records are unpacked in one pass
+    straight from a memoryview of the data.
+
+    >>> markets, prices, micros = unmarshal_columns(b'GBPUSDe6\\x9c?\\x00\\x04\\tT\\xdd5@\\x00' + bytes(14))
+    >>> markets == [market_id('GBP/USD')], prices, micros
+    (True, array('d', [1.2204099893569946]), array('q', [1136160000000000]))
 
     Args:
-        data (bytes): The byte array containing quote data.
+        data (bytes): The byte array containing quote data (any bytes-like object).
 
     Returns:
-        list: A list of dictionaries representing quotes with keys 'cross', 'price', and 'time'.
+        tuple: (markets, prices, micros) where markets is a list of interned market ids
+            (see fxp_bytes.market_id), prices is an array of floats and micros is an
+            array of timestamps in microseconds since the epoch.
+    """
+    view = memoryview(data)
+    if view and view[0] == VERSION_2:
+        quotes = unmarshal_quotes_v2(view)
+        return ([quote.market for quote in quotes], array("d", [quote.price for quote in quotes]),
+                array("q", [quote.micros for quote in quotes]))
+    records = QUOTE_RECORD.iter_unpack(view[:len(view) - len(view) % QUOTE_SIZE])
+    interned = MARKET_IDS.get
+    markets, prices, micros = [], array("d"), array("q")
+    for market, price, timestamp in records:
+        mid = interned(market)
+        markets.append(mid if mid is not None else market_id(market))
+        prices.append(price)
+        micros.append(timestamp)
+    micros.byteswap()  # from big-endian
+    return markets, prices, micros
+
+def unmarshal_quotes(data) -> list:
+    """
+    Unmarshals a byte array of quote data into Quote records. Version 2
+    messages are recognized by their first byte; anything else is version 1.
+
+    >>> [(q.cross, q.micros) for q in unmarshal_quotes(b'GBPUSDe6\\x9c?\\x00\\x04\\tT\\xdd5@\\x00' + bytes(14))]
+    [('GBP/USD', 1136160000000000)]
+
+    Args:
+        data (bytes): The byte array containing quote data (any bytes-like object).
+
+    Returns:
+        list: A list of fxp_bytes.Quote (market id, price, epoch microseconds).
+    """
+    view = memoryview(data)
+    if view and view[0] == VERSION_2:
+        return unmarshal_quotes_v2(view)
+    records = QUOTE_RECORD_BYTES_TIME.iter_unpack(view[:len(view) - len(view) % QUOTE_SIZE])
+    interned = MARKET_IDS.get
+    new_quote = tuple.__new__  # skips Quote.__new__'s Python-level argument handling
+    from_bytes = int.from_bytes
+    quotes = []
+    for market, price, timestamp in records:
+        mid = interned(market)
+        if mid is None:
+            mid = market_id(market)
+        quotes.append(new_quote(Quote, (mid, price, from_bytes(timestamp, "big"))))
+    return quotes
+
+def unmarshal_quotes_v2(data) -> list:
     """
-    quotes_list = []
-    quote_size = 32  # Expected size of quote structure in bytes
+    Unmarshals a version 2 message (see fxp_bytes.marshal_message_v2) into
+    Quote records. Records for markets outside the agreed table are skipped,
+    and so are any the datagram was cut short before (all of them, if it
+    doesn't even hold the header).
+
+    >>> unmarshal_quotes_v2(b'\\x02\\x01\\x00\\x04\\tT\\xdd5@\\x00\\xd9B\\xd8\\x80\\x00\\x00\\x00\\x00\\xfa')[0][1:]
+    (108.25, 1136160000000250)
+    >>> unmarshal_quotes_v2(b'\\x02\\x01\\x00\\x04')
+    []
+
+    Args:
+        data (bytes): The message (any bytes-like object).
 
-    for i in range(0, len(data), quote_size):
-        each_quote = data[i : i + quote_size]
+    Returns:
+        list: A list of fxp_bytes.Quote (market id, price, epoch microseconds).
+    """
+    view = memoryview(data)
+    if len(view) < V2_HEADER.size:
+        return []
+    _version, count, base = V2_HEADER.unpack_from(view)
+    count = min(count, (len(view) - V2_HEADER.size) // V2_RECORD.size)
+    records = V2_RECORD.iter_unpack(view[V2_HEADER.size:V2_HEADER.size + count * V2_RECORD.size])
+    ids = V2_MARKET_IDS
+    new_quote = tuple.__new__
+    return [new_quote(Quote, (ids[number], price, base + offset))
+            for number, price, offset in records if number < len(ids)]
+
+def quotes_from_columns(markets, prices, micros) -> list:
+    """
+    Builds the dictionary form of quotes from the columns returned by unmarshal_columns.
+
+    Args:
+        markets (list): Interned market ids.
+        prices (array): Prices.
+        micros (array): Timestamps in microseconds since the epoch.
 
-        currency_pair = each_quote[0:6].decode("ascii")
-        price_bytes = each_quote[6:10]
-        time_bytes = each_quote[10:18]
+    Returns:
+        list: A list of dictionaries representing quotes with keys 'cross', 'price', and 'time'.
+    """
+    quotes = [Quote(*quote).as_dict() for quote in zip(markets, prices, micros)]
+    for quote in quotes:
+        quote["price"] = round(quote["price"], 4)
+    return quotes
 
-        price = deserialize_price(price_bytes)
-        timestamp = deserialize_utcdatetime(time_bytes)
-        formatted_currency_pair = f"{currency_pair[:3]}/{currency_pair[3:]}"
+def unmarshal_message(data: bytes) -> list:
+    """
+    Unmarshals a byte array of quote data into a list of dictionaries.
 
-        quote_dict = {"cross": formatted_currency_pair, "price": price, "time": timestamp}
-        quotes_list.append(quote_dict)
+    Args:
+        data (bytes): The byte array containing quote data.
 
-    return quotes_list
+    Returns:
+        list: A list of dictionaries representing quotes with keys 'cross', 'price', and 'time'.
+    """
+    return quotes_from_columns(*unmarshal_columns(data))
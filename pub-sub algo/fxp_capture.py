@@ -0,0 +1,191 @@
+"""
+Capture and replay of the Forex Provider feed.
+
+A capture file is append-only: an 8-byte magic header, then one frame per
+datagram received, each frame being the receive time (little-endian int64
+epoch microseconds) and the datagram length (little-endian uint32) followed
+by the raw datagram exactly as it came off the wire, fxp_bytes records and all.
+
+Record with: python3 lab3.py localhost 50500 session.fxcap
+Replay with: python3 fxp_capture.py session.fxcap [--realtime] [--speed 2]
+"""
+import argparse
+import mmap
+import os
+import struct
+import time
+
+import fxp_bytes
+
+MAGIC = b"FXPCAP1\n"
+FRAME_HEADER = struct.Struct("<qI")  # receive time in epoch micros, datagram length
+
+
+class CaptureWriter(object):
+    """
+    Appends received datagrams to a capture file.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "test.fxcap")
+    >>> with CaptureWriter(path) as capture:
+    ...     capture.write(b"first", 1000)
+    ...     capture.write(b"second", 2000)
+    >>> with CaptureReader(path) as frames:
+    ...     [(received, bytes(datagram)) for received, datagram in frames]
+    [(1000, b'first'), (2000, b'second')]
+    """
+
+    def __init__(self, path):
+        """
+        Open the file for appending, writing the header if it is new.
+
+        Args:
+            path (str): Capture file to create or extend.
+        """
+        self.file = open(path, "ab", buffering=1 << 16)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.frames = 0
+
+    def write(self, datagram, received):
+        """
+        Append one datagram.
+
+        Args:
+            datagram (bytes): The datagram as received (any bytes-like object).
+            received (int): Time it was received in epoch microseconds.
+        """
+        self.file.write(FRAME_HEADER.pack(received, len(datagram)))
+        self.file.write(datagram)
+        self.frames += 1
+
+    def flush(self):
+        """
+        Push everything written so far out to the file.
+        """
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureReader(object):
+    """
+    Memory-maps a capture file and iterates over its frames without copying
+    the datagrams. A frame cut short at the end of the file (the capturing
+    process died mid-write) is ignored, and an empty file (it died before
+    anything was flushed) has no frames.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Capture file written by CaptureWriter.
+        """
+        with open(path, "rb") as file:
+            empty = os.fstat(file.fileno()).st_size == 0
+            self.map = None if empty else mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map is None:
+            self.view = memoryview(MAGIC)  # no frames
+        elif self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a feed capture")
+        else:
+            self.view = memoryview(self.map)
+
+    def __iter__(self):
+        """
+        Yields:
+            tuple: (receive time in epoch microseconds, memoryview of the datagram),
+                the view being released as soon as the next frame is asked for
+        """
+        view, unpack_from = self.view, FRAME_HEADER.unpack_from
+        offset, end = len(MAGIC), len(view)
+        while offset + FRAME_HEADER.size <= end:
+            received, length = unpack_from(view, offset)
+            offset += FRAME_HEADER.size
+            if offset + length > end:
+                break
+            datagram = view[offset:offset + length]
+            try:
+                yield received, datagram
+            finally:
+                datagram.release()  # or the mmap can't be closed
+            offset += length
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # a view made from a datagram is still alive (say, in a traceback); the map goes with it
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def replay(path, lab, realtime=False, speed=1.0):
+    """
+    Drive a Lab3 subscriber from a capture, running detection after each
+    datagram. Quotes are judged stale against the recorded receive times, so
+    the result is the same whatever the pace of the replay.
+
+    Args:
+        path (str): Capture file.
+        lab (Lab3): Subscriber to feed; it never opens a socket.
+        realtime (bool): Keep the recorded gaps between datagrams (default is as
+            fast as possible).
+        speed (float): With realtime, play this many times faster than recorded.
+
+    Returns:
+        tuple: (datagrams replayed, seconds taken)
+    """
+    count = 0
+    started = time.perf_counter()
+    with CaptureReader(path) as reader:
+        frames = iter(reader)
+        try:
+            first = None
+            for received, datagram in frames:
+                if realtime:
+                    if first is None:
+                        first = received
+                    delay = (received - first) / fxp_bytes.MICROS_PER_SECOND / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                lab.apply_datagram(datagram, received)
+                lab.detect_arbitrage()
+                count += 1
+        finally:
+            frames.close()  # releases the last datagram's view, even if applying it failed
+    return count, time.perf_counter() - started
+
+
+def main():
+    from lab3 import Lab3
+
+    parser = argparse.ArgumentParser(description="Replay a feed capture through Lab3")
+    parser.add_argument("path")
+    parser.add_argument("--realtime", action="store_true", help="keep the recorded timing")
+    parser.add_argument("--speed", type=float, default=1.0, help="realtime speed-up factor")
+    parser.add_argument("--quiet", action="store_true", help="only log arbitrage found")
+    args = parser.parse_args()
+
+    lab = Lab3(None, None, verbose=not args.quiet)
+    count, elapsed = replay(args.path, lab, args.realtime, args.speed)
+    rate = count / elapsed if elapsed > 0 else float("inf")
+    print(f"Replayed {count} datagrams in {elapsed:.3f} s ({rate:.0f} datagrams/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Fan-out of one marshalled Forex Provider message to many subscribers.
+
+On Linux the datagrams go out in batches with sendmmsg (one system call
+for up to SENDMMSG_MAX subscribers); elsewhere with one sendto each.
+Subscribers can be split over several sockets, each sent to from its own
+thread, or the message can be sent once to an IP multicast group instead.
+"""
+import ctypes
+import socket
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+SENDMMSG_MAX = 1024  # UIO_MAXIOV, the most messages the kernel takes per call
+CACHED_GROUPS = 8  # subscriber lists sent to without a group whose address arrays are kept between sends
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint32), ('sin_zero', ctypes.c_ubyte * 8)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint),
+                ('msg_iov', ctypes.POINTER(_IoVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+class _Batch(object):
+    """
+    Prebuilt sendmmsg arguments for one share of the subscribers: an address
+    and a message header for each, all pointing at one iovec that is aimed
+    at the current message before every send.
+    """
+
+    def __init__(self, subscribers):
+        count = len(subscribers)
+        self.iov = _IoVec()
+        self.addresses = (_SockAddrIn * count)()
+        self.headers = (_MMsgHdr * count)()
+        for address, header, (host, port) in zip(self.addresses, self.headers, subscribers):
+            address.sin_family = socket.AF_INET
+            address.sin_port = socket.htons(port)
+            address.sin_addr = int.from_bytes(socket.inet_aton(socket.gethostbyname(host)), sys.byteorder)
+            header.msg_hdr.msg_name = ctypes.addressof(address)
+            header.msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+            header.msg_hdr.msg_iov = ctypes.pointer(self.iov)
+            header.msg_hdr.msg_iovlen = 1
+
+    def send(self, sock, message):
+        """
+        :return: number of datagrams the kernel accepted
+        """
+        buffer = ctypes.create_string_buffer(message, len(message))
+        self.iov.iov_base = ctypes.addressof(buffer)
+        self.iov.iov_len = len(message)
+        fd, base, size = sock.fileno(), ctypes.addressof(self.headers), ctypes.sizeof(_MMsgHdr)
+        count, sent, done = len(self.headers), 0, 0
+        while done < count:
+            result = _sendmmsg(fd, base + done * size, min(count - done, SENDMMSG_MAX), 0)
+            if result < 0:
+                done += 1  # the datagram at done failed (e.g. unreachable); skip it
+            else:
+                done += result
+                sent += result
+        return sent
+
+
+class FanOut(object):
+    """
+    Sends one message to a list of subscribers (or to a multicast group).
+    """
+
+    def __init__(self, sockets=1, multicast_group=None, multicast_ttl=1):
+        """
+        :param sockets: number of sockets (and sending threads) to split the
+                        subscribers over
+        :param multicast_group: (group ip, port) to send each message to once,
+                                instead of to each subscriber
+        :param multicast_ttl: how many router hops multicast datagrams may cross
+        """
+        self.sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(max(1, sockets))]
+        self.pool = ThreadPoolExecutor(len(self.sockets)) if len(self.sockets) > 1 else None
+        self.multicast_group = multicast_group
+        if multicast_group is not None:
+            self.sockets[0].setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+        self.batches = OrderedDict()  # tuple of subscribers -> list of _Batch, one per socket; least recent first
+        self.group_batches = {}  # group -> (tuple of subscribers, list of _Batch), for sends naming a group
+
+    def send(self, message, subscribers, group=None):
+        """
+        Send message to every subscriber. The sendmmsg arguments built for a
+        list of subscribers are kept for the next send to the same list: one
+        set for each group named, until its subscribers change or it is
+        forgotten, and the CACHED_GROUPS most recently used otherwise.
+
+        :param message: marshalled message (any bytes-like object)
+        :param subscribers: list of (ip address, port) pairs; ignored in multicast mode
+        :param group: hashable name for this list of subscribers, if it is
+                      sent to again and again (e.g. a publisher's group key)
+        :return: number of datagrams sent
+        """
+        if self.multicast_group is not None:
+            self.sockets[0].sendto(message, self.multicast_group)
+            return 1
+        if not subscribers:
+            return 0
+        message = bytes(message)
+        if _sendmmsg is not None:
+            batches = self.cached_batches(tuple(subscribers), group)
+            jobs = [(batch.send, (sock, message)) for batch, sock in zip(batches, self.sockets) if len(batch.headers)]
+        else:
+            shares = [subscribers[i::len(self.sockets)] for i in range(len(self.sockets))]
+            jobs = [(self.send_each, (sock, message, share)) for share, sock in zip(shares, self.sockets) if share]
+        if self.pool is None or len(jobs) == 1:
+            return sum(send(*args) for send, args in jobs)
+        return sum(future.result() for future in [self.pool.submit(send, *args) for send, args in jobs])
+
+    def cached_batches(self, subscribers, group):
+        """
+        :param subscribers: tuple of (ip address, port) pairs
+        :param group: as for send
+        :return: list of _Batch for subscribers, one per socket
+        """
+        if group is not None:
+            cached = self.group_batches.get(group)
+            if cached is None or cached[0] != subscribers:
+                cached = self.group_batches[group] = (subscribers, self.make_batches(subscribers))
+            return cached[1]
+        batches = self.batches.get(subscribers)
+        if batches is None:
+            if len(self.batches) >= CACHED_GROUPS:
+                self.batches.popitem(last=False)
+            batches = self.batches[subscribers] = self.make_batches(subscribers)
+        else:
+            self.batches.move_to_end(subscribers)
+        return batches
+
+    def make_batches(self, subscribers):
+        return [_Batch(subscribers[i::len(self.sockets)]) for i in range(len(self.sockets))]
+
+    def forget(self, group):
+        """
+        Drop what was kept for a group that won't be sent to again.
+        """
+        self.group_batches.pop(group, None)
+
+    @staticmethod
+    def send_each(sock, message, subscribers):
+        """
+        Send with one sendto per subscriber, where sendmmsg isn't available.
+        """
+        sent = 0
+        for subscriber in subscribers:
+            try:
+                sock.sendto(message, subscriber)
+                sent += 1
+            except OSError:
+                pass
+        return sent
+
+    def setblocking(self, flag):
+        """
+        With flag False, a datagram that doesn't fit in a socket's send buffer
+        is dropped instead of waited for.
+        """
+        for sock in self.sockets:
+            sock.setblocking(flag)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        for sock in self.sockets:
+            sock.close()
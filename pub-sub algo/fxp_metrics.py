@@ -0,0 +1,172 @@
+"""
+In-process metrics for the Forex Provider.
+
+Counters, gauges and latency histograms, served as JSON to anyone who
+sends a datagram to the stats socket and/or printed every few seconds.
+
+echo | nc -u -w1 localhost 50405
+"""
+import json
+import os
+import socket
+import threading
+import time
+
+HISTOGRAM_BUCKETS = 40  # bucket i holds durations under 2**(i/2) microseconds
+
+
+class Histogram(object):
+    """
+    Latency histogram with buckets at powers of sqrt(2) microseconds, so
+    percentiles come out within about 41%.
+
+    >>> h = Histogram()
+    >>> for micros in (10, 10, 10, 1000):
+    ...     h.record(micros)
+    >>> h.snapshot()
+    {'count': 4, 'mean': 257.5, 'p50': 11.3, 'p99': 1024.0, 'max': 1000}
+    """
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, micros):
+        """
+        :param micros: a duration in microseconds
+        """
+        self.buckets[min(int(max(micros, 1) ** 2).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, p):
+        """
+        :param p: percentile wanted, 0 to 100
+        :return: upper bound of the bucket it falls in, in microseconds
+        """
+        wanted = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return round(2 ** (i / 2), 1)
+        return 0
+
+    def snapshot(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': round(self.total / self.count, 1),
+                'p50': self.percentile(50), 'p99': self.percentile(99), 'max': round(self.max, 1)}
+
+
+class RateWindow(object):
+    """
+    Where one reader of the metrics took its last snapshot, so rates are
+    worked out over the time since that reader last looked. Each reader
+    needs its own, or one reader would cut the other's window short.
+    """
+
+    def __init__(self, metrics):
+        """
+        :param metrics: ProviderMetrics this window is over
+        """
+        self.last = (metrics.started, 0, 0, 0)  # (time, datagrams, bytes, tick microseconds) at the last snapshot
+
+
+class ProviderMetrics(object):
+    """
+    Everything a publisher counts. Counters are plain attributes bumped from
+    the publishing thread; gauges are functions read when a snapshot is taken.
+
+    >>> metrics = ProviderMetrics()
+    >>> served, dumped = RateWindow(metrics), RateWindow(metrics)
+    >>> metrics.datagrams += 100
+    >>> metrics.snapshot(served)['datagrams_per_s'] > 0
+    True
+    >>> metrics.datagrams += 50
+    >>> served.last[1], dumped.last[1]
+    (100, 0)
+    >>> metrics.snapshot(dumped)['datagrams']
+    150
+    >>> served.last[1], dumped.last[1]
+    (100, 150)
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ticks = 0
+        self.datagrams = 0
+        self.bytes = 0
+        self.expirations = 0
+        self.tick = Histogram()  # whole publish, in microseconds
+        self.marshal = Histogram()  # marshalling for one subscriber group
+        self.send = Histogram()  # fan-out of one group's messages
+        self.gauges = {}  # name -> function returning the current value
+
+    def snapshot(self, window=None):
+        """
+        :param window: RateWindow of the reader taking the snapshot, moved up
+                       to now (default measures since the metrics started)
+        :return: dict of all the metrics, with rates and the fraction of time
+                 spent publishing since the window's previous snapshot
+        """
+        now = time.monotonic()
+        then, datagrams, sent_bytes, tick_micros = window.last if window is not None else (self.started, 0, 0, 0)
+        elapsed = max(now - then, 1e-9)
+        if window is not None:
+            window.last = (now, self.datagrams, self.bytes, self.tick.total)
+        stats = {
+            'pid': os.getpid(),
+            'uptime_s': round(now - self.started, 3),
+            'ticks': self.ticks,
+            'datagrams': self.datagrams,
+            'bytes': self.bytes,
+            'expirations': self.expirations,
+            'datagrams_per_s': round((self.datagrams - datagrams) / elapsed, 1),
+            'bytes_per_s': round((self.bytes - sent_bytes) / elapsed, 1),
+            'busy': round((self.tick.total - tick_micros) / 1e6 / elapsed, 4),
+            'tick_us': self.tick.snapshot(),
+            'marshal_us': self.marshal.snapshot(),
+            'send_us': self.send.snapshot(),
+        }
+        for name, gauge in self.gauges.items():
+            stats[name] = gauge()
+        return stats
+
+
+class MetricsReporter(object):
+    """
+    Background threads that answer stats requests and/or print the metrics
+    periodically.
+    """
+
+    def __init__(self, metrics, address=None, interval=None):
+        """
+        :param metrics: ProviderMetrics to report
+        :param address: (host, port) for the UDP stats socket; any datagram sent
+                        there is answered with the metrics as JSON
+        :param interval: seconds between printing the metrics (default never)
+        """
+        self.metrics = metrics
+        if address is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind(address)
+            threading.Thread(target=self.serve, daemon=True).start()
+        if interval:
+            threading.Thread(target=self.dump, args=(interval,), daemon=True).start()
+
+    def serve(self):
+        window = RateWindow(self.metrics)
+        while True:
+            _request, address = self.socket.recvfrom(64)
+            self.socket.sendto(json.dumps(self.metrics.snapshot(window)).encode('utf-8'), address)
+
+    def dump(self, interval):
+        window = RateWindow(self.metrics)
+        while True:
+            time.sleep(interval)
+            print('stats {}'.format(json.dumps(self.metrics.snapshot(window))))
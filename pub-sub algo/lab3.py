@@ -8,10 +8,19 @@ you changed
 
 run python3 lab3.py cs1.seattleu.edu anyport
 
+To also record the feed for replaying with fxp_capture.py, name a capture file:
+
+run python3 lab3.py cs1.seattleu.edu anyport session.fxcap
+
  
 """
 
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import atexit
+import heapq
+import os
+import signal
 import socket
 import sys
 import threading
@@ -20,103 +29,506 @@ import math
 
 import fxp_bytes
 import fxp_bytes_subscriber as fxp_bytes_s
-from bellman_ford import BellmanFord  # Import the BellmanFord class from bellmanFord.py
+from fxp_capture import CaptureWriter
+from bellman_ford import BellmanFord, VertexMap, shortest_paths_from_snapshot
 
 SUB_TIMEOUT = 10 * 60
 BUFFER_TIME = 0.1
 QUOTE_TIMEOUT = 1.5
+QUOTE_TIMEOUT_MICROS = int(QUOTE_TIMEOUT * 1_000_000)
+BUFFER_TIME_MICROS = int(BUFFER_TIME * 1_000_000)
+MAX_DATAGRAM_SIZE = fxp_bytes.MAX_QUOTES_PER_MESSAGE * fxp_bytes.QUOTE_SIZE
+RECEIVE_RING_SIZE = 64  # most datagrams drained per wakeup
+SOCKET_RECEIVE_BUFFER = 4 * 1024 * 1024  # bytes requested for SO_RCVBUF (the kernel may cap it)
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40 if sys.platform.startswith("linux") else None)
 DEFAULT_USD_AMOUNT = 100
 
 
+class DatagramReceiver(object):
+    """
+    Receives datagrams into a preallocated ring of buffers, draining every
+    datagram that is ready each time it wakes up. Keeps counts of datagrams
+    received, datagrams too big for MAX_DATAGRAM_SIZE (truncated), and, on
+    Linux, datagrams the kernel dropped because the socket buffer was full.
+    """
+
+    def __init__(self, sock, ring_size=RECEIVE_RING_SIZE, receive_buffer=SOCKET_RECEIVE_BUFFER):
+        """
+        Initialize the receiver.
+
+        Args:
+            sock (socket.socket): Bound UDP socket to receive on.
+            ring_size (int): Number of receive buffers, the most datagrams returned at once.
+            receive_buffer (int): Socket receive buffer size to ask the kernel for.
+        """
+        self.sock = sock
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.drop_counter_size = socket.CMSG_SPACE(4)
+        except (TypeError, OSError, AttributeError):  # no kernel drop counter on this platform
+            self.drop_counter_size = 0
+        # one spare byte per buffer, so a datagram bigger than the largest valid one shows up
+        self.ring = [memoryview(bytearray(MAX_DATAGRAM_SIZE + 1)) for _ in range(ring_size)]
+        self.next = 0
+        self.received = 0
+        self.truncated = 0
+        self.dropped = 0
+
+    def receive_batch(self, timeout=None, limit=None):
+        """
+        Wait for a datagram, then also take every other one that is already waiting.
+        The returned views are only good until the ring comes back around, i.e.
+        until the next call.
+
+        Args:
+            timeout (float): Seconds to wait for the first datagram (default forever).
+            limit (int): Most datagrams to return (default is the ring size).
+
+        Returns:
+            list: A memoryview of each datagram received, empty if the timeout expired.
+        """
+        limit = len(self.ring) if limit is None else min(limit, len(self.ring))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            first = None
+            while first is None:
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()  # a truncated datagram doesn't start the wait over
+                    if timeout <= 0:
+                        return []
+                self.sock.settimeout(timeout)
+                first = self.receive_into_ring(0)
+        except socket.timeout:
+            return []
+        finally:
+            self.sock.settimeout(None)
+
+        batch = [first]
+        while len(batch) < limit:
+            try:
+                datagram = self.receive_into_ring(socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            if datagram is not None:
+                batch.append(datagram)
+        return batch
+
+    def receive_into_ring(self, flags):
+        """
+        Receive one datagram into the next buffer of the ring. The ring only
+        moves on past a valid datagram, so a batch never uses more buffers
+        than the ring has, however many truncated ones it skips.
+
+        Args:
+            flags (int): Flags for the receive call.
+
+        Returns:
+            memoryview: The datagram, or None if it was too big to be a valid message.
+        """
+        view = self.ring[self.next]
+
+        if self.drop_counter_size:
+            nbytes, ancdata, _msg_flags, _address = self.sock.recvmsg_into([view], self.drop_counter_size, flags)
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                    self.dropped = int.from_bytes(data[:4], sys.byteorder)  # running total from the kernel
+        else:
+            nbytes = self.sock.recv_into(view, 0, flags)
+
+        self.received += 1
+        if nbytes > MAX_DATAGRAM_SIZE:
+            self.truncated += 1
+            return None  # leave the buffer to be reused
+        self.next = (self.next + 1) % len(self.ring)
+        return view[:nbytes]
+
+
+class CycleCache(object):
+    """
+    Arbitrage cycles found by recent searches, indexed by the edges they use,
+    so that a quote touching one of those edges only costs re-checking the
+    cycles through it rather than a full search.
+
+    >>> from bellman_ford import BellmanFord
+    >>> graph = BellmanFord({'USD': {'EUR': -0.5}, 'EUR': {'GBP': 0.25}, 'GBP': {'USD': 0.0}})
+    >>> cache = CycleCache(max_age=2)
+    >>> cache.replace([['USD', 'EUR', 'GBP', 'USD']], graph)
+    >>> graph.add_edge('EUR', 'GBP', 0.375)  # worse, but still profitable
+    >>> cache.touch('EUR', 'GBP')
+    >>> cache.answer(graph, 1e-15), cache.cycles
+    ([['USD', 'EUR', 'GBP', 'USD']], {('USD', 'EUR', 'GBP', 'USD'): -0.125})
+    >>> cache.answer(graph, 1e-15)  # nothing touched: answered without re-checking
+    [['USD', 'EUR', 'GBP', 'USD']]
+    >>> cache.answer(graph, 1e-15) is None  # max_age answers given, so a full search is due
+    True
+    >>> cache.replace([['USD', 'EUR', 'GBP', 'USD']], graph)
+    >>> graph.remove_edge('GBP', 'USD')
+    >>> cache.touch('GBP', 'USD')
+    >>> cache.answer(graph, 1e-15) is None  # the cycle is gone
+    True
+    """
+
+    def __init__(self, max_age):
+        """
+        Initialize the cache.
+
+        Args:
+            max_age (int): Number of detections the cache may answer before a full
+                search is forced anyway, so new opportunities elsewhere are found.
+        """
+        self.max_age = max_age
+        self.age = 0
+        self.cycles = {}  # tuple of currencies in trading order -> total edge weight
+        self.by_edge = {}  # (from, to) -> set of cycles using that edge
+        self.touched = set()  # cycles to re-check before the next answer
+
+    def replace(self, cycles, graph):
+        """
+        Forget the cached cycles and cache the results of a full search.
+
+        Args:
+            cycles (list): Lists of currencies in trading order.
+            graph (BellmanFord): The graph the cycles were found in.
+        """
+        self.cycles.clear()
+        self.by_edge.clear()
+        self.touched.clear()
+        self.age = 0
+        for steps in cycles:
+            cycle = tuple(steps)
+            self.cycles[cycle] = self.weight(cycle, graph)
+            for edge in zip(cycle, cycle[1:]):
+                self.by_edge.setdefault(edge, set()).add(cycle)
+
+    def touch(self, from_vertex, to_vertex):
+        """
+        Note that an edge changed or was removed.
+        """
+        cycles = self.by_edge.get((from_vertex, to_vertex))
+        if cycles:
+            self.touched.update(cycles)
+
+    def answer(self, graph, tolerance):
+        """
+        Re-check the touched cycles against the current graph and return the ones
+        still profitable, or None if a full search is needed instead.
+
+        Args:
+            graph (BellmanFord): The current graph.
+            tolerance (float): Cycles must have total weight below -tolerance.
+
+        Returns:
+            list: Profitable cycles as lists of currencies, or None.
+        """
+        for cycle in self.touched:
+            if cycle in self.cycles:
+                self.cycles[cycle] = self.weight(cycle, graph)
+        self.touched.clear()
+
+        self.age += 1
+        live = [list(cycle) for cycle, weight in self.cycles.items() if weight < -tolerance]
+        if not live or self.age > self.max_age:
+            return None
+        return live
+
+    @staticmethod
+    def weight(cycle, graph):
+        """
+        Total edge weight around a cycle, or +inf if one of its edges is gone.
+        """
+        store = graph.store
+        total = 0
+        for from_vertex, to_vertex in zip(cycle, cycle[1:]):
+            slot = store.slot(from_vertex, to_vertex)
+            if slot is None:
+                return float('inf')
+            total += store.weight[slot]
+        return total
+
 
 class Lab3(object):
-    def __init__(self, subscriber_address, publisher_address):
+    def __init__(self, subscriber_address, publisher_address, bellman_ford=None, top_k=None,
+                 coalesce_window=None, coalesce_max=None, origins=('USD',), workers=None,
+                 verbose=True, cycle_cache=None, capture_path=None, version=fxp_bytes.VERSION_2,
+                 multicast_group=None, markets=None, max_rate=None):
         """
         Initialize the Lab3 class.
 
         Args:
             subscriber_address (tuple): The address of the subscriber.
             publisher_address (tuple): The address of the publisher.
+            bellman_ford (BellmanFord): Graph engine used for arbitrage detection,
+                e.g. bellman_ford_numpy.NumpyBellmanFord() for large graphs
+                or bellman_ford.IncrementalBellmanFord() (default is a new BellmanFord).
+            top_k (int): If given, report up to this many of the most profitable
+                arbitrage cycles anywhere in the graph each tick, instead of just
+                the one cycle found from USD.
+            coalesce_window (float): If given, after a datagram arrives keep applying
+                any others that arrive within this many seconds (e.g. 0.002) and only
+                then run detection once for all of them.
+            coalesce_max (int): Run detection after at most this many coalesced
+                datagrams, even if the window hasn't closed (default is no limit).
+            origins (tuple): Currencies we hold and look for arbitrage from (default USD only).
+                With top_k, cycles are printed starting from the first one if possible.
+            workers (int): If given, search from the origins in parallel on a pool of
+                this many processes, each sent a compact snapshot of the graph.
+            verbose (bool): Log every message, quote and stale edge, not just
+                arbitrage found (default is True).
+            cycle_cache (int): If given, remember the cycles found and, while any is
+                still profitable, report those instead of searching again, for up to
+                this many detections in a row.
+            capture_path (str): If given, append every datagram received, with its
+                receive time, to this capture file (see fxp_capture).
+            version (int): Newest message version to ask the publisher for (default 2,
+                the compact format; either version is understood when it arrives).
+            multicast_group (tuple): If the publisher sends to an IP multicast group,
+                its (group ip, port) to join and listen on. We still subscribe, so the
+                publisher knows someone is listening.
+            markets (list): Crosses to ask the publisher for, such as "GBP/USD"
+                (default all of them).
+            max_rate (int): Most messages a second to ask the publisher for; it sends
+                the latest price for each market in between (default every tick).
         """
         self.publisher_address = publisher_address
         self.subscriber_address = subscriber_address
-        self.graph = {}
-        self.bellman_ford = BellmanFord()  # Initialize BellmanFord
+        self.bellman_ford = bellman_ford if bellman_ford is not None else BellmanFord()
         self.timestamps = {}  # Store last update times for currency pairs
+        self.top_k = top_k
+        self.expiry_heap = []  # (expiry time in epoch micros, market id), oldest first
+        self.coalesce_window = coalesce_window
+        self.coalesce_max = coalesce_max
+        self.origins = list(origins)
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(workers) if workers else None
+        self.verbose = verbose
+        self.cycle_cache = CycleCache(cycle_cache) if cycle_cache else None
+        self.capture = CaptureWriter(capture_path) if capture_path else None
+        self.version = version
+        self.multicast_group = multicast_group
+        self.markets = markets
+        self.max_rate = max_rate
 
     def listen_to_publisher(self):
         """
         Listen to the publisher for incoming data.
         """
         listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        listener.bind(self.subscriber_address)
-        current_time = datetime.now() + (datetime.utcnow() - datetime.now())
+        if self.multicast_group is None:
+            listener.bind(self.subscriber_address)
+        else:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(("", self.multicast_group[1]))
+            membership = socket.inet_aton(self.multicast_group[0]) + socket.inet_aton("0.0.0.0")
+            listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        receiver = DatagramReceiver(listener)
+        self.print_log_item(f"Socket receive buffer is {listener.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes")
+        lost = 0
 
         while True:
-            byte_msg = listener.recv(1024)
-            demarshaled_data = fxp_bytes_s.unmarshal_message(byte_msg)
-            print(f"Demarshaled message: {demarshaled_data}")
+            # everything already waiting is applied before detection runs
+            batch = receiver.receive_batch(limit=self.coalesce_max)
+            self.apply_batch(batch)
+            if self.coalesce_window is not None:
+                self.coalesce_datagrams(receiver, len(batch))
+            self.detect_arbitrage()
+
+            if receiver.truncated + receiver.dropped != lost:
+                lost = receiver.truncated + receiver.dropped
+                self.print_log_item(f"Received {receiver.received} datagrams, {receiver.truncated} truncated, "
+                                    f"{receiver.dropped} dropped by the kernel")
+
+    def coalesce_datagrams(self, receiver, count=1):
+        """
+        Apply any more datagrams that arrive within the coalescing window after
+        the first ones, so that detection runs once for the whole burst.
 
-            for quote in demarshaled_data:
-                timestamp = quote["time"]
-                time_diff = (current_time - timestamp).total_seconds()
-                self.remove_stale_edges()
+        Args:
+            receiver (DatagramReceiver): The receiver the first datagrams came from.
+            count (int): Number of datagrams already applied.
+        """
+        started = time.perf_counter()
+        deadline = started + self.coalesce_window
+
+        while self.coalesce_max is None or count < self.coalesce_max:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            limit = None if self.coalesce_max is None else self.coalesce_max - count
+            batch = receiver.receive_batch(remaining, limit)
+            if not batch:
+                break
+            self.apply_batch(batch)
+            count += len(batch)
+
+        added_latency = (time.perf_counter() - started) * 1000
+        self.print_log_item(f"Coalesced {count} datagrams, detection delayed {added_latency:.3f} ms")
+
+    def apply_batch(self, batch):
+        """
+        Apply a batch of datagrams received together, capturing them first if
+        a capture file is open. The capture is flushed after every batch, so
+        it is on disk however the process ends.
 
-                if time_diff < BUFFER_TIME:
-                    currency_pair = tuple(quote["cross"].split("/"))
-                    self.print_log_item("{} {} {} {}".format(timestamp, currency_pair[0], currency_pair[1], quote["price"]))
-                    self.add_edge_to_graph(currency_pair, quote)
+        Args:
+            batch (list): The datagrams, as returned by DatagramReceiver.receive_batch.
+        """
+        received = fxp_bytes.now_micros()  # one clock read for the batch
+        capture = self.capture
+        for byte_msg in batch:
+            if capture is not None:
+                capture.write(byte_msg, received)
+            self.apply_datagram(byte_msg, received)
+        if capture is not None and batch:
+            capture.flush()
+
+    def apply_datagram(self, byte_msg, current_time=None):
+        """
+        Unmarshal one datagram from the publisher and apply its quotes to the graph.
 
-                else:
-                    self.print_log_item("Ignoring out-of-sequence message")
+        Args:
+            byte_msg (bytes): The datagram as received.
+            current_time (int): Time the datagram was received in epoch microseconds
+                (default reads the clock).
+        """
+        quotes = fxp_bytes_s.unmarshal_quotes(byte_msg)
+        if self.verbose:
+            print(f"Demarshaled message: {[quote.as_dict() for quote in quotes]}")
+        if current_time is None:
+            current_time = fxp_bytes.now_micros()  # read the clock once per datagram
+        self.remove_stale_edges(current_time)
+        self.apply_quotes(quotes, current_time)
+
+    def apply_quotes(self, quotes, current_time):
+        """
+        Add the quotes to the graph, skipping any that are out of sequence.
 
-            distances, predecessors, negative_edge = self.bellman_ford.shortest_paths('USD', 1e-15)
-            print(f"Negative cycle (Prev Dictionary): {predecessors}")
-            print(f"Negative edge: {negative_edge}")
+        Args:
+            quotes (list): fxp_bytes.Quote records as returned by
+                fxp_bytes_subscriber.unmarshal_quotes.
+            current_time (int): Time the quotes were received in epoch microseconds.
+        """
+        for quote in quotes:
+            if current_time - quote.micros < BUFFER_TIME_MICROS:
+                if self.verbose:
+                    self.print_log_item("{} {} {} {}".format(quote.time, *fxp_bytes.MARKET_PAIRS[quote.market], quote.price))
+                self.add_edge_to_graph(quote)
 
-            if negative_edge:
-                self.calculate_and_print_arbitrage(predecessors, 'USD', negative_edge)
+            elif self.verbose:
+                self.print_log_item("Ignoring out-of-sequence message")
 
-    def add_edge_to_graph(self, currency_pair, quote):
+    def detect_arbitrage(self):
         """
-        Add an edge to the graph and Bellman-Ford algorithm.
+        Look for arbitrage in the current graph and print what is found.
+        """
+        for steps in self.find_arbitrage():
+            self.print_arbitrage(steps)
 
-        Args:
-            currency_pair (tuple): The currency pair.
-            quote (dict): The quote data.
+    def find_arbitrage(self):
         """
-        rate = -1 * math.log(quote["price"])
-        
-        if currency_pair[0] not in self.graph:
-            self.graph[currency_pair[0]] = {}
+        Look for arbitrage in the current graph, answering from the cycle cache
+        when it can.
 
-        self.graph[currency_pair[0]][currency_pair[1]] = {"timestamp": quote["time"], "price": rate}
-        self.bellman_ford.add_edge(currency_pair[0], currency_pair[1], rate)
+        Returns:
+            list: One list of currencies in trading order per arbitrage cycle found,
+                each starting and ending with the same currency.
+        """
+        if self.cycle_cache is None:
+            return self.search_arbitrage()
 
-        if currency_pair[1] not in self.graph:
-            self.graph[currency_pair[1]] = {}
+        cycles = self.cycle_cache.answer(self.bellman_ford, 1e-15)
+        if cycles is None:
+            cycles = self.search_arbitrage()
+            self.cycle_cache.replace(cycles, self.bellman_ford)
+        return cycles
 
-        self.graph[currency_pair[1]][currency_pair[0]] = {"timestamp": quote["time"], "price": -1 * rate}
-        self.bellman_ford.add_edge(currency_pair[1], currency_pair[0], -1 * rate)
+    def search_arbitrage(self):
+        """
+        Search the whole graph for arbitrage.
 
-    def remove_stale_edges(self):
+        Returns:
+            list: One list of currencies in trading order per arbitrage cycle found.
         """
-        Remove stale edges from the graph.
+        if self.top_k is not None:
+            return self.ranked_arbitrage(self.origins[0])
+
+        if self.pool is not None:
+            results = self.search_origins_in_parallel()
+        else:
+            results = ((origin,) + self.bellman_ford.shortest_paths(origin, 1e-15)[1:] for origin in self.origins)
+
+        cycles = []
+        for origin, predecessors, negative_edge in results:
+            if self.verbose:
+                print(f"Negative cycle (Prev Dictionary): {predecessors}")
+                print(f"Negative edge: {negative_edge}")
+
+            if negative_edge:
+                cycles.append(self.arbitrage_steps(predecessors, origin, negative_edge))
+        return cycles
+
+    def search_origins_in_parallel(self):
         """
-        to_remove = []
+        Run the shortest-path search from every origin on the process pool. Each
+        worker gets one snapshot of the graph and its share of the origins.
 
-        for curr1 in self.graph:
-            to_remove.clear()
+        Returns:
+            list: (origin, predecessors, negative_edge) for each origin in the graph,
+                in the order of self.origins.
+        """
+        snapshot = self.bellman_ford.snapshot()
+        shares = [self.origins[i::self.workers] for i in range(self.workers)]
+        futures = [self.pool.submit(shortest_paths_from_snapshot, snapshot, share, 1e-15)
+                   for share in shares if share]
+        store = self.bellman_ford.store
+        results = {origin: (origin, VertexMap(store, predecessor, of_vertices=True), negative_edge)
+                   for future in futures
+                   for origin, predecessor, negative_edge in future.result()}
+        return [results[origin] for origin in self.origins if origin in results]
+
+    def add_edge_to_graph(self, quote):
+        """
+        Add an edge to the graph and Bellman-Ford algorithm.
+
+        Args:
+            quote (fxp_bytes.Quote): The quote for the currency pair.
+        """
+        market, price, timestamp = quote
+        currency_pair = fxp_bytes.MARKET_PAIRS[market]
+        rate = -1 * math.log(price)
+        self.bellman_ford.add_edge(currency_pair[0], currency_pair[1], rate, timestamp)
+        self.bellman_ford.add_edge(currency_pair[1], currency_pair[0], -1 * rate, timestamp)
+        if self.cycle_cache is not None:
+            self.cycle_cache.touch(*currency_pair)
+            self.cycle_cache.touch(currency_pair[1], currency_pair[0])
+        heapq.heappush(self.expiry_heap, (timestamp + QUOTE_TIMEOUT_MICROS, market))
+
+    def remove_stale_edges(self, now=None):
+        """
+        Remove stale edges from the graph.
 
-            for curr2 in self.graph[curr1]:
-                if (datetime.utcnow() - self.graph[curr1][curr2]["timestamp"]).total_seconds() > QUOTE_TIMEOUT:
-                    to_remove.append((curr1, curr2))
+        Only the expiry heap entries that are due get looked at. An entry is
+        left behind every time a cross is quoted, so when one comes due the
+        edge may since have been refreshed (or already removed) and is kept.
 
-            for curr1, curr2 in to_remove:
-                self.bellman_ford.remove_edge(curr1, curr2)
-                #self.bellman_ford.remove_edge(curr2, curr1)
-                del self.graph[curr1][curr2]
-                print(f"Removing stale quote for ({curr1}, {curr2})")
+        Args:
+            now (int): Current time in epoch microseconds (default reads the clock).
+        """
+        if now is None:
+            now = fxp_bytes.now_micros()
+        store = self.bellman_ford.store
+
+        while self.expiry_heap and self.expiry_heap[0][0] < now:
+            _expires, market = heapq.heappop(self.expiry_heap)
+            currency_pair = fxp_bytes.MARKET_PAIRS[market]
+            for curr1, curr2 in (currency_pair, currency_pair[::-1]):
+                slot = store.slot(curr1, curr2)
+                if slot is not None and store.timestamp[slot] + QUOTE_TIMEOUT_MICROS < now:
+                    self.bellman_ford.remove_edge(curr1, curr2)
+                    if self.cycle_cache is not None:
+                        self.cycle_cache.touch(curr1, curr2)
+                    if self.verbose:
+                        print(f"Removing stale quote for ({curr1}, {curr2})")
 
     def calculate_and_print_arbitrage(self, predecessors, origin, negative_edge, init_value=DEFAULT_USD_AMOUNT):
         """
@@ -128,17 +540,69 @@ class Lab3(object):
             negative_edge (tuple): The negative edge tuple.
             init_value (float): The initial USD amount (default is 100).
         """
-        current_amount = init_value
-        arbitrage_path = []
+        self.print_arbitrage(self.arbitrage_steps(predecessors, origin, negative_edge), init_value)
+
+    def arbitrage_steps(self, predecessors, origin, negative_edge):
+        """
+        Follow the predecessors back around a negative cycle.
+
+        Args:
+            predecessors (dict): The predecessors dictionary.
+            origin (str): The origin currency.
+            negative_edge (tuple): The negative edge tuple.
+
+        Returns:
+            list: Currencies in trading order, starting and ending with the origin,
+                or with a currency on the cycle if the cycle misses the origin.
+        """
         steps = [origin]
         final_edge = negative_edge[0]
 
         while not final_edge == origin:
+            if final_edge in steps:  # the cycle doesn't pass through origin, so trade around it alone
+                steps = steps[steps.index(final_edge):]
+                origin = final_edge
+                break
             steps.append(final_edge)
             final_edge = predecessors[final_edge]
 
         steps.append(origin)
         steps.reverse()
+        return steps
+
+    def ranked_arbitrage(self, preferred_origin):
+        """
+        Find distinct arbitrage cycles anywhere in the graph in one sweep. Not
+        every overlapping cycle is listed, but every arbitrage cycle in the
+        graph shares a trade with one that is (see BellmanFord.negative_cycles).
+
+        Args:
+            preferred_origin (str): Cycles through this currency start from it;
+                others start from their first currency.
+
+        Returns:
+            list: The top_k most profitable cycles, most profitable first, each a list
+                of currencies in trading order.
+        """
+        cycles = []
+        for weight, cycle in self.bellman_ford.negative_cycles(1e-15, self.top_k):
+            if preferred_origin in cycle:
+                i = cycle.index(preferred_origin)
+                cycle = cycle[i:-1] + cycle[:i + 1]
+            cycles.append(cycle)
+        return cycles
+
+    def print_arbitrage(self, steps, init_value=DEFAULT_USD_AMOUNT):
+        """
+        Print the trades around one arbitrage cycle.
+
+        Args:
+            steps (list): Currencies in trading order, starting and ending with the origin.
+            init_value (float): The initial amount of the origin currency (default is 100).
+        """
+        origin = steps[0]
+        current_amount = init_value
+        arbitrage_path = []
         previous = origin
 
         print("ARBITRAGE:")
@@ -148,15 +612,15 @@ class Lab3(object):
             current_currency = steps[i]
             rate = math.exp(-1 * self.bellman_ford.edges[previous][current_currency])
             current_amount *= rate
-            test = self.bellman_ford.edges[previous][current_currency]
             arbitrage_path.append(f"Exchange {previous} for {current_currency} at {rate} --> {current_amount}")
             previous = current_currency
 
         for detail in arbitrage_path:
             print(detail)
 
-        print(f"Final Amount (USD): {current_amount}")
+        print(f"Final Amount ({origin}): {current_amount}")
         print(f"Profit: {current_amount - init_value} {origin}")
+        print(f"Profit ratio: {current_amount / init_value}")
 
     def subscribe_to_publisher(self):
         """
@@ -166,8 +630,9 @@ class Lab3(object):
             self.print_log_item(f"Sending SUBSCRIBE to {self.publisher_address}")
 
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-                serialized_addr = fxp_bytes_s.serialize_address(self.subscriber_address[0], self.subscriber_address[1])
-                sock.sendto(serialized_addr, self.publisher_address)
+                request = fxp_bytes_s.serialize_subscription(self.subscriber_address[0], self.subscriber_address[1],
+                                                             self.version, self.markets, self.max_rate)
+                sock.sendto(request, self.publisher_address)
                 sock.close()
 
             time.sleep(SUB_TIMEOUT)
@@ -182,6 +647,16 @@ class Lab3(object):
         subscribe_thread = threading.Thread(target=self.subscribe_to_publisher)
         subscribe_thread.start()
 
+    def close(self):
+        """
+        Close the capture file, if one is open, and the process pool, if any.
+        """
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
     def print_log_item(self, msg):
         """
         Print log messages with a timestamp.
@@ -192,15 +667,24 @@ class Lab3(object):
         print("[" + str(datetime.now()) + "]", msg)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python lab3.py [host] [port]")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python lab3.py [host] [port] [capture file]")
         exit(1)
 
     host, host_port = sys.argv[1], sys.argv[2]
     host_port = int(host_port)
+    capture_path = sys.argv[3] if len(sys.argv) == 4 else None
 
     # Set the subscriber's address
     subscriber_address = (host, host_port)
     publisher_address = ('localhost', 50403)
-    subscriber = Lab3(subscriber_address, publisher_address)
+    subscriber = Lab3(subscriber_address, publisher_address, capture_path=capture_path)
+
+    def stop(signum, frame):
+        subscriber.close()
+        sys.stdout.flush()
+        os._exit(0)  # the listener thread is blocked receiving, so don't wait for it
+
+    signal.signal(signal.SIGTERM, stop)
+    atexit.register(subscriber.close)  # e.g. after Ctrl-C
     subscriber.run()